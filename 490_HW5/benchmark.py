@@ -0,0 +1,641 @@
+import os
+import json
+import math
+import time
+import asyncio
+import random
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.nn import functional as F
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler
+from gpt.bpe import get_encoder, get_pairs
+from gpt.decoding import sample_next_token, apply_repetition_penalty
+from gpt.model import GPT
+from gpt.quantize import quantize_dynamic, quantize_weight_only, model_size_mb
+from gpt.server import InferenceServer
+from gpt.trainer import Trainer, evaluate_loader, evaluate_stream
+from gpt.utils import set_seed, reset_peak_memory, current_memory_mb, peak_memory_mb
+
+VOCAB_SIZE = 50257 # openai's model vocabulary
+
+
+def build_model(model_type, block_size=1024, **overrides):
+    config = GPT.get_default_config()
+    config.model_type = model_type
+    config.vocab_size = VOCAB_SIZE
+    config.block_size = block_size
+    config.merge_from_dict(overrides)
+    model = GPT(config)
+    model.eval()
+    return model
+
+
+def time_it(fn, repeats=3):
+    """ run fn once to warm up, then return the best wall clock time of `repeats` runs """
+    fn()
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+class RandomTokenDataset(Dataset):
+    """ fixed random token sequences, to benchmark training without downloading any data """
+    def __init__(self, num_sequences, block_size):
+        self.num_sequences = num_sequences
+        self.block_size = block_size
+
+    def __len__(self):
+        return self.num_sequences
+
+    def __getitem__(self, idx):
+        generator = torch.Generator().manual_seed(idx)
+        return torch.randint(VOCAB_SIZE, (self.block_size,), generator=generator)
+
+
+def stack_collate_fn(batch):
+    batch_ids = torch.stack(batch)
+    return batch_ids, batch_ids, torch.ones(batch_ids.shape, dtype=torch.float32)
+
+
+def random_dataloader(num_sequences, block_size, batch_size, shuffle=True):
+    return DataLoader(RandomTokenDataset(num_sequences, block_size), batch_size=batch_size, shuffle=shuffle,
+                      collate_fn=stack_collate_fn)
+
+
+def build_trainer(model, train_dataloader, dev_dataloader, max_iters, **overrides):
+    config = Trainer.get_default_config()
+    config.device = 'cpu'
+    config.max_iters = max_iters
+    config.merge_from_dict(overrides)
+    return Trainer(config, model, train_dataloader, dev_dataloader)
+
+
+def measure_peak_mb(fn, device='cpu'):
+    """ run fn and return how far the peak memory rose above the memory in use before it, in MB """
+    reset_peak_memory(device)
+    baseline = current_memory_mb(device)
+    fn()
+    return peak_memory_mb(device) - baseline
+
+
+def saved_activations_mb(fn, model):
+    """ run fn and return the size of the tensors autograd keeps for backward, the parameters of model aside, in MB """
+    parameters = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in parameters:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(saved.values()) / 2**20
+
+
+def bench_kv_cache(model_types=('gpt-nano', 'gpt-micro', 'gpt-mini', 'gopher-44m', 'gpt2'), prompt_len=16,
+                   max_new_tokens=128, batch_size=1):
+    """ tokens/sec of GPT.generate with and without the kv cache, on CPU """
+    print(f"{'-' * 10} KV cache: {prompt_len} prompt tokens, {max_new_tokens} new tokens, batch {batch_size} {'-' * 10}")
+    print(f"{'model':>12} {'no cache tok/s':>16} {'cache tok/s':>14} {'speedup':>9}")
+    for model_type in model_types:
+        set_seed(3407)
+        model = build_model(model_type)
+        idx = torch.randint(VOCAB_SIZE, (batch_size, prompt_len))
+        dt_full = time_it(lambda: model.generate(idx, max_new_tokens, use_cache=False), repeats=1)
+        dt_cache = time_it(lambda: model.generate(idx, max_new_tokens, use_cache=True), repeats=1)
+        # greedy decoding should produce the same tokens either way (up to float rounding on near ties)
+        match = torch.equal(model.generate(idx, max_new_tokens, use_cache=False),
+                            model.generate(idx, max_new_tokens, use_cache=True))
+        n_tokens = batch_size * max_new_tokens
+        print(f"{model_type:>12} {n_tokens / dt_full:>16.1f} {n_tokens / dt_cache:>14.1f} "
+              f"{dt_full / dt_cache:>8.2f}x {'' if match else '(outputs differ)'}")
+
+
+def bench_attention_backends(model_type='gpt-micro', seq_lens=(128, 256, 512, 1024), batch_size=8):
+    """ eager vs. fused scaled-dot-product attention: numerical agreement, step time and peak memory on CPU """
+    print(f"{'-' * 10} Attention backends: {model_type}, batch {batch_size}, forward + backward {'-' * 10}")
+    print(f"{'T':>6} {'max |diff|':>11} {'eager ms':>9} {'sdpa ms':>9} {'eager MB':>9} {'sdpa MB':>9}")
+    for T in seq_lens:
+        set_seed(3407)
+        eager = build_model(model_type, block_size=T, attn_backend='eager')
+        sdpa = build_model(model_type, block_size=T, attn_backend='sdpa')
+        sdpa.load_state_dict(eager.state_dict())
+        idx = torch.randint(VOCAB_SIZE, (batch_size, T))
+        mask = torch.ones(batch_size, T)
+        with torch.no_grad():
+            diff = (eager(idx)[0] - sdpa(idx)[0]).abs().max().item()
+
+        def step(model):
+            model.zero_grad(set_to_none=True)
+            _, loss = model(idx, idx, mask)
+            loss.backward()
+
+        ms_eager = time_it(lambda: step(eager)) * 1000
+        ms_sdpa = time_it(lambda: step(sdpa)) * 1000
+        mb_eager = measure_peak_mb(lambda: step(eager))
+        mb_sdpa = measure_peak_mb(lambda: step(sdpa))
+        print(f"{T:>6} {diff:>11.2e} {ms_eager:>9.1f} {ms_sdpa:>9.1f} {mb_eager:>9.1f} {mb_sdpa:>9.1f}")
+
+
+def bench_compile(model_type='gpt-micro', block_size=256, batch_size=8, max_new_tokens=64, backend='inductor'):
+    """ eager vs. torch.compile'd step time of training (forward + backward) and of the decode step, on CPU """
+    print(f"{'-' * 10} torch.compile ({backend}): {model_type}, batch {batch_size} x {block_size} {'-' * 10}")
+    print(f"{'step':>8} {'eager ms':>9} {'compiled ms':>12} {'speedup':>8} {'compile s':>10}")
+    set_seed(3407)
+    model = build_model(model_type, block_size=block_size)
+    idx = torch.randint(VOCAB_SIZE, (batch_size, block_size))
+    mask = torch.ones(batch_size, block_size)
+    compiled = torch.compile(model, backend=backend)
+
+    def train_step(model):
+        model.zero_grad(set_to_none=True)
+        _, loss = model(idx, idx, mask)
+        loss.backward()
+
+    def report(name, run_eager, run_compiled, scale):
+        # the first compiled call pays for the compilation
+        start = time.perf_counter()
+        run_compiled()
+        compile_s = time.perf_counter() - start
+        ms_eager = time_it(run_eager) * 1000 / scale
+        ms_compiled = time_it(run_compiled) * 1000 / scale
+        print(f"{name:>8} {ms_eager:>9.2f} {ms_compiled:>12.2f} {ms_eager / ms_compiled:>7.2f}x {compile_s:>10.1f}")
+
+    report('train', lambda: train_step(model), lambda: train_step(compiled), 1)
+    # per generated token, with the kv cache; the prefill runs eagerly in both
+    prompt = idx[:1, :16]
+    eager_model = build_model(model_type, block_size=block_size)
+    eager_model.load_state_dict(model.state_dict())
+    decode_model = build_model(model_type, block_size=block_size).compile_decode(backend)
+    decode_model.load_state_dict(model.state_dict())
+    report('decode', lambda: eager_model.generate(prompt, max_new_tokens),
+           lambda: decode_model.generate(prompt, max_new_tokens), max_new_tokens)
+
+
+def bench_tie_weights(model_types=('gpt-nano', 'gpt-micro', 'gpt-mini'), block_size=128, batch_size=16):
+    """ parameters, training state memory, peak step memory and step time with and without tied embeddings """
+    print(f"{'-' * 10} Tied embeddings: batch {batch_size} x {block_size}, AdamW {'-' * 10}")
+    print(f"{'model':>10} {'tied':>5} {'params M':>9} {'state MB':>9} {'peak MB':>8} {'step ms':>8}")
+    idx = torch.randint(VOCAB_SIZE, (batch_size, block_size))
+    mask = torch.ones(batch_size, block_size)
+    for model_type in model_types:
+        for tied in (False, True):
+            set_seed(3407)
+            model = build_model(model_type, block_size=block_size, tie_weights=tied)
+            model.train()
+            optimizer = model.configure_optimizers(Trainer.get_default_config())
+            n_params = sum(p.numel() for p in model.parameters())
+            # fp32 weights, gradients and the two AdamW moments
+            state_mb = 4 * 4 * n_params / 2**20
+
+            def step():
+                optimizer.zero_grad(set_to_none=True)
+                _, loss = model(idx, idx, mask)
+                loss.backward()
+                optimizer.step()
+
+            ms = time_it(step) * 1000
+            peak = measure_peak_mb(step)
+            print(f"{model_type:>10} {str(tied):>5} {n_params / 1e6:>9.2f} {state_mb:>9.1f} {peak:>8.1f} {ms:>8.1f}")
+
+
+def bench_loss_impl(model_type='gpt-micro', block_size=256, batch_size=16, chunk_sizes=(256, 1024)):
+    """ full vs. chunked vs. sampled softmax loss: gradient agreement, peak memory and step time on CPU """
+    print(f"{'-' * 10} LM head loss: {model_type}, batch {batch_size} x {block_size}, vocab {VOCAB_SIZE} {'-' * 10}")
+    print(f"{'loss':>14} {'loss value':>11} {'max |grad diff|':>16} {'peak MB':>8} {'step ms':>8}")
+    idx = torch.randint(VOCAB_SIZE, (batch_size, block_size))
+    mask = torch.ones(batch_size, block_size)
+    settings = [('full', {})] + [(f'chunked {n}', dict(loss_impl='chunked', loss_chunk_size=n)) for n in chunk_sizes]
+    settings.append(('sampled 1024', dict(loss_impl='sampled', sampled_softmax_k=1024)))
+    reference = None
+    for name, overrides in settings:
+        set_seed(3407)
+        model = build_model(model_type, block_size=block_size, **overrides)
+        model.train()
+
+        def step():
+            model.zero_grad(set_to_none=True)
+            _, loss = model(idx, idx, mask)
+            loss.backward()
+            return loss
+
+        # dropout draws from the global rng, reseed so every setting drops the same units
+        set_seed(3407)
+        loss = step().item()
+        grads = [p.grad.clone() for p in model.parameters()]
+        reference = reference or grads
+        diff = max((g - r).abs().max().item() for g, r in zip(grads, reference))
+        ms = time_it(step) * 1000
+        peak = measure_peak_mb(step)
+        print(f"{name:>14} {loss:>11.4f} {diff:>16.2e} {peak:>8.1f} {ms:>8.1f}")
+
+
+def bench_decoding(model_type='gpt-micro', batch_size=16, top_k=40, num_beams=(1, 4, 8), max_new_tokens=32):
+    """ per step cost of the sampling filters over the 50257 token vocabulary, and beam search throughput on CPU """
+    print(f"{'-' * 10} Decoding: batch {batch_size}, vocab {VOCAB_SIZE} {'-' * 10}")
+    logits = torch.randn(batch_size, VOCAB_SIZE)
+    idx = torch.randint(VOCAB_SIZE, (batch_size, 256))
+
+    def masked_top_k():
+        # what generate used to do: a comparison and a masked write over the whole vocabulary
+        masked = logits.clone()
+        v, _ = torch.topk(masked, top_k)
+        masked[masked < v[:, [-1]]] = -float('Inf')
+        return torch.multinomial(F.softmax(masked, dim=-1), num_samples=1)
+
+    settings = [(f'top_k {top_k}, masked', masked_top_k),
+                (f'top_k {top_k}', lambda: sample_next_token(logits, top_k=top_k)),
+                ('top_p 0.9', lambda: sample_next_token(logits, top_p=0.9)),
+                (f'top_k {top_k}, top_p 0.9', lambda: sample_next_token(logits, top_k=top_k, top_p=0.9)),
+                ('min_p 0.05', lambda: sample_next_token(logits, min_p=0.05)),
+                ('repetition 1.2', lambda: apply_repetition_penalty(logits, idx, 1.2))]
+    print(f"{'filter':>22} {'us/step':>8}")
+    for name, fn in settings:
+        print(f"{name:>22} {time_it(lambda: [fn() for _ in range(10)]) / 10 * 1e6:>8.0f}")
+
+    model = build_model(model_type)
+    prompt = torch.randint(VOCAB_SIZE, (batch_size // 4, 16))
+    print(f"{'beams':>6} {'tok/s':>8}")
+    for n in num_beams:
+        dt = time_it(lambda: model.generate(prompt, max_new_tokens, num_beams=n), repeats=1)
+        print(f"{n:>6} {prompt.size(0) * max_new_tokens / dt:>8.1f}")
+
+
+def bench_speculative(target_type='gpt2-medium', draft_type='gpt2', ks=(2, 4, 6), max_new_tokens=64,
+                      prompts=(' The best way to learn', ' According to the latest research', ' It was a dark and')):
+    """ acceptance rate and wall clock speedup of speculative decoding with a smaller draft model, on CPU """
+    print(f"{'-' * 10} Speculative decoding: {target_type} verifying {draft_type}, {max_new_tokens} new tokens {'-' * 10}")
+    # pretrained models, randomly initialized ones would hardly ever agree with each other
+    target, draft = GPT.from_pretrained(target_type).eval(), GPT.from_pretrained(draft_type).eval()
+    encoder = get_encoder()
+    idxs = [torch.tensor([encoder.encode(prompt)], dtype=torch.long) for prompt in prompts]
+    print(f"{'k':>3} {'mode':>7} {'accepted':>9} {'tok/s':>8} {'speedup':>8}")
+    for do_sample in (False, True):
+        mode = 'sample' if do_sample else 'greedy'
+        set_seed(3407)
+        dt_base = sum(time_it(lambda: target.generate(idx, max_new_tokens, do_sample=do_sample, top_k=40), repeats=1)
+                      for idx in idxs)
+        print(f"{'-':>3} {mode:>7} {'-':>9} {len(idxs) * max_new_tokens / dt_base:>8.1f} {1.0:>7.2f}x")
+        for k in ks:
+            set_seed(3407)
+            dt, proposed, accepted = 0.0, 0, 0
+            for idx in idxs:
+                dt += time_it(lambda: target.generate(idx, max_new_tokens, do_sample=do_sample, top_k=40,
+                                                      draft_model=draft, speculative_k=k), repeats=1)
+                proposed += target.speculative_stats['proposed']
+                accepted += target.speculative_stats['accepted']
+            print(f"{k:>3} {mode:>7} {accepted / max(proposed, 1):>9.0%} {len(idxs) * max_new_tokens / dt:>8.1f} "
+                  f"{dt_base / dt:>7.2f}x")
+
+
+def wikitext_dev_dataloader(block_size, batch_size, cache_dir=os.path.join(os.path.expanduser('~'), '.cache', 'gpt')):
+    """ the wikitext-103 validation split as packed block_size windows, tokenized to cache_dir only the first time """
+    from data import (load_dataset, preprocess_to_disk, bpe_tokenizer, MemmapWikiTextDataset, create_dataloader,
+                      wikitext_cache_prefix)
+    prefix = wikitext_cache_prefix('validation', cache_dir)
+    if not os.path.exists(prefix + '.bin'):
+        raw_data = load_dataset(path="wikitext", name="wikitext-103-raw-v1", split="validation")
+        preprocess_to_disk(raw_data, prefix, bpe_tokenizer)
+    return create_dataloader(MemmapWikiTextDataset(prefix, block_size), batch_size, shuffle=False)
+
+
+def bench_quantize(model_type='gpt2', block_size=256, batch_size=8, eval_batches=16, max_new_tokens=32,
+                   ppl_tolerance=0.02):
+    """
+    fp32 vs. int8 (dynamic and weight-only) inference: dev perplexity, size, forward and decode speed on CPU.
+    Fails if quantizing raises the dev perplexity by more than ppl_tolerance (relative).
+    """
+    print(f"{'-' * 10} Int8 quantization: {model_type}, wikitext-103 dev {eval_batches} x {batch_size} x {block_size} {'-' * 10}")
+    # pretrained, the perplexity of a randomly initialized model says nothing about the quantization error
+    model = GPT.from_pretrained(model_type).eval()
+    dev_dataloader = wikitext_dev_dataloader(block_size, batch_size)
+    idx = next(iter(dev_dataloader))[0]
+    print(f"{'model':>12} {'size MB':>8} {'dev loss':>9} {'ppl':>8} {'d ppl':>7} {'fwd ms':>8} {'decode tok/s':>13}")
+    base_ppl = None
+    for name, quantized in [('fp32', model), ('int8 dynamic', quantize_dynamic(model)),
+                            ('int8 weights', quantize_weight_only(model))]:
+        loss_sum, tokens = evaluate_loader(quantized, dev_dataloader, 'cpu', max_batches=eval_batches)
+        loss = loss_sum / tokens
+        ppl = math.exp(loss)
+        base_ppl = base_ppl or ppl
+        with torch.no_grad():
+            ms = time_it(lambda: quantized(idx)) * 1000
+            dt = time_it(lambda: quantized.generate(idx[:1, :16], max_new_tokens), repeats=1)
+        print(f"{name:>12} {model_size_mb(quantized):>8.1f} {loss:>9.4f} {ppl:>8.2f} {ppl / base_ppl - 1:>+7.1%} "
+              f"{ms:>8.1f} {max_new_tokens / dt:>13.1f}")
+        assert ppl / base_ppl - 1 <= ppl_tolerance, f"{name} raises the dev perplexity by {ppl / base_ppl - 1:.1%}"
+
+
+def bench_stream_eval(model_type='gpt2', block_size=1024, strides=(1024, 512, 256), num_tokens=2**15, batch_size=4):
+    """ dev perplexity of independent chunks vs. strided sliding windows over the token stream, and their cost on CPU """
+    print(f"{'-' * 10} Sliding window perplexity: {model_type}, first {num_tokens} tokens of wikitext-103 dev {'-' * 10}")
+    model = GPT.from_pretrained(model_type).eval()
+    stream = wikitext_dev_dataloader(block_size, batch_size).dataset.token_stream()[:num_tokens]
+    chunks = DataLoader(list(stream[:len(stream) // block_size * block_size].split(block_size)), batch_size=batch_size,
+                        collate_fn=stack_collate_fn)
+    print(f"{'evaluation':>16} {'predicted':>10} {'ppl':>8} {'tok/s':>8}")
+    settings = [('chunks', lambda: evaluate_loader(model, chunks, 'cpu'))]
+    settings += [(f'stride {stride}', lambda stride=stride: evaluate_stream(model, stream, 'cpu', stride, batch_size))
+                 for stride in strides]
+    for name, evaluate in settings:
+        start = time.perf_counter()
+        loss_sum, tokens = evaluate()
+        dt = time.perf_counter() - start
+        print(f"{name:>16} {tokens:>10.0f} {math.exp(loss_sum / tokens):>8.2f} {len(stream) / dt:>8.0f}")
+
+
+def bench_server(model_type='gpt-micro', num_clients=(1, 4, 16), requests_per_client=4, max_batch_size=16,
+                 prompt_lens=(8, 64), new_tokens=(16, 64)):
+    """ load generator for the continuous batching server: request latency and aggregate throughput """
+    print(f"{'-' * 10} Inference server: {model_type}, max batch {max_batch_size} {'-' * 10}")
+    print(f"{'clients':>8} {'requests':>9} {'p50 s':>8} {'p99 s':>8} {'tok/s':>9}")
+    set_seed(3407)
+    model = build_model(model_type)
+
+    async def client(server, latencies, counts):
+        for _ in range(requests_per_client):
+            prompt = [random.randrange(VOCAB_SIZE) for _ in range(random.randint(*prompt_lens))]
+            start = time.perf_counter()
+            tokens = await server.generate(prompt, max_new_tokens=random.randint(*new_tokens), do_sample=True)
+            latencies.append(time.perf_counter() - start)
+            counts.append(len(tokens))
+
+    async def load(n):
+        latencies, counts = [], []
+        async with InferenceServer(model, max_batch_size=max_batch_size) as server:
+            start = time.perf_counter()
+            await asyncio.gather(*[client(server, latencies, counts) for _ in range(n)])
+            wall = time.perf_counter() - start
+        return latencies, sum(counts) / wall
+
+    for n in num_clients:
+        latencies, tokens_per_sec = asyncio.run(load(n))
+        p50, p99 = np.percentile(latencies, [50, 99])
+        print(f"{n:>8} {len(latencies):>9} {p50:>8.3f} {p99:>8.3f} {tokens_per_sec:>9.1f}")
+
+
+def bench_bpe_merge(token_lens=(100, 1000, 5000)):
+    """ speed of the heap vs. classic bpe merge engines on long tokens (tests/test_bpe.py checks that they agree) """
+    print(f"{'-' * 10} BPE merge engines {'-' * 10}")
+    classic, heap = get_encoder(), get_encoder()
+    classic.merge_engine = 'classic'
+    print(f"{'token':>12} {'len':>6} {'classic ms':>11} {'heap ms':>9}")
+    for n in token_lens:
+        for name, token in (('digits', '1234567890' * (n // 10)), ('spaces', 'Ġ' * n),
+                            ('url', ('https://www.example.com/path?q=' * n)[:n])):
+            word = tuple(token)
+            ms_classic = time_it(lambda: classic._merge_classic(word, get_pairs(word)), repeats=1) * 1000
+            ms_heap = time_it(lambda: heap._merge_heap(word), repeats=1) * 1000
+            assert classic._merge_classic(word, get_pairs(word)) == heap._merge_heap(word)
+            print(f"{name:>12} {n:>6} {ms_classic:>11.1f} {ms_heap:>9.1f}")
+
+
+def bench_bucketing(block_size=32, batch_size=256, max_tokens=4096, model_type='gpt-nano', num_batches=20):
+    """ padding waste and real tokens/s of uniformly shuffled vs. length bucketed vs. token budget vs. segment packed batches """
+    from data import (load_dataset, tokenize_data, prepare_data, bpe_tokenizer, collate_fn, segment_collate_fn,
+                      WikiTextDataset, SegmentPackedWikiTextDataset, BucketBatchSampler, padding_waste)
+    print(f"{'-' * 10} Bucketed batching: wikitext-103 dev, block size {block_size}, {model_type} {'-' * 10}")
+    raw_data = load_dataset(path="wikitext", name="wikitext-103-raw-v1", split="validation")
+    dataset = WikiTextDataset(prepare_data(tokenize_data(raw_data, bpe_tokenizer), block_size), block_size)
+    segment_packed = SegmentPackedWikiTextDataset(dataset.data, block_size)
+    lengths = [len(example) for example in dataset.data]
+    segment_packed_lengths = [len(row) for row in segment_packed.data]
+    settings = [('uniform', dataset, lengths, BatchSampler(RandomSampler(dataset), batch_size, drop_last=False)),
+                ('bucketed', dataset, lengths, BucketBatchSampler(lengths, batch_size)),
+                (f'{max_tokens} tokens', dataset, lengths, BucketBatchSampler(lengths, max_tokens=max_tokens)),
+                ('segment packed', segment_packed, segment_packed_lengths,
+                 BatchSampler(RandomSampler(segment_packed), batch_size, drop_last=False))]
+    model = build_model(model_type, block_size=block_size)
+    model.train()
+    print(f"{'batches':>14} {'count':>6} {'lines/batch':>12} {'padding':>8} {'real tok/s':>11}")
+    for name, data, data_lengths, sampler in settings:
+        batches = list(sampler)
+        collate = segment_collate_fn if data is segment_packed else collate_fn
+        timed = [collate([data[i] for i in batch]) for batch in batches[:num_batches]]
+
+        def steps():
+            for input_ids, labels, masks, *segment_ids in timed:
+                model.zero_grad(set_to_none=True)
+                _, loss = model(input_ids, labels, masks, segment_ids=segment_ids[0] if segment_ids else None)
+                loss.backward()
+
+        real_tokens = sum(batch[2].sum().item() for batch in timed)
+        dt = time_it(steps, repeats=1)
+        print(f"{name:>14} {len(batches):>6} {len(lengths) / len(batches):>12.1f} "
+              f"{padding_waste(batches, data_lengths):>8.1%} {real_tokens / dt:>11.0f}")
+
+
+def _ddp_worker(rank, world_size, port, model_type, block_size, batch_size, max_iters, results):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), RANK=str(rank), WORLD_SIZE=str(world_size))
+    # split the cores between the processes instead of oversubscribing them
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    set_seed(3407)
+    model = build_model(model_type, block_size=block_size)
+    train_dataloader = random_dataloader(64 * batch_size * world_size, block_size, batch_size)
+    dev_dataloader = random_dataloader(batch_size, block_size, batch_size, shuffle=False)
+    trainer = build_trainer(model, train_dataloader, dev_dataloader, max_iters, distributed=True)
+    # time from the end of the first (warm up) step to the end of the last one, on the master
+    times = []
+    trainer.add_callback('on_batch_end', lambda trainer: times.append(time.perf_counter()))
+    trainer.run()
+    if trainer.is_master:
+        tokens = (max_iters - 1) * batch_size * block_size * world_size
+        results.put(tokens / (times[-1] - times[0]))
+    torch.distributed.destroy_process_group()
+
+
+def bench_prefetch(model_type='gpt-micro', block_size=128, batch_size=16, max_iters=30, collate_ms=20,
+                   settings=((0, 0), (2, 0), (2, 2))):
+    """ training step time and data-wait fraction with a slow collate, with and without the prefetch stage """
+    print(f"{'-' * 10} Prefetching: {model_type}, {collate_ms}ms collate per batch {'-' * 10}")
+    print(f"{'prefetch':>9} {'workers':>8} {'ms/step':>8} {'data wait':>10}")
+
+    def slow_collate_fn(batch):
+        time.sleep(collate_ms / 1000)
+        return stack_collate_fn(batch)
+
+    for prefetch_batches, num_workers in settings:
+        set_seed(3407)
+        model = build_model(model_type, block_size=block_size)
+        train_dataloader = DataLoader(RandomTokenDataset(64 * batch_size, block_size), batch_size=batch_size,
+                                      shuffle=True, collate_fn=slow_collate_fn, num_workers=num_workers)
+        dev_dataloader = random_dataloader(batch_size, block_size, batch_size, shuffle=False)
+        trainer = build_trainer(model, train_dataloader, dev_dataloader, max_iters, prefetch_batches=prefetch_batches)
+        steps = []
+        trainer.add_callback('on_batch_end', lambda trainer: steps.append((time.perf_counter(), trainer.iter_data_wait)))
+        trainer.run()
+        # skip the first step, it includes the start up of the pipeline
+        ms = (steps[-1][0] - steps[0][0]) / (len(steps) - 1) * 1000
+        wait = sum(w for _, w in steps[1:]) / (len(steps) - 1) * 1000
+        print(f"{prefetch_batches:>9} {num_workers:>8} {ms:>8.1f} {wait / ms:>10.0%}")
+
+
+def bench_step_breakdown(model_type='gpt-micro', block_size=128, batch_size=16, max_iters=20,
+                         metrics_path='metrics/bench_step_breakdown.jsonl'):
+    """ where the time of a training step goes, read back from the trainer's JSONL metrics """
+    print(f"{'-' * 10} Step breakdown: {model_type}, {batch_size} x {block_size} tokens per step {'-' * 10}")
+    set_seed(3407)
+    model = build_model(model_type, block_size=block_size)
+    train_dataloader = random_dataloader(64 * batch_size, block_size, batch_size)
+    dev_dataloader = random_dataloader(batch_size, block_size, batch_size, shuffle=False)
+    if os.path.exists(metrics_path):
+        os.remove(metrics_path)
+    build_trainer(model, train_dataloader, dev_dataloader, max_iters, metrics_path=metrics_path).run()
+    with open(metrics_path) as f:
+        # the first line describes the run, skip it and the warm up step
+        steps = [json.loads(line) for line in f][2:]
+    phases = ('data_wait', 'forward', 'backward', 'optimizer')
+    print(' '.join(f'{name + " ms":>13}' for name in phases + ('dt',)) + f" {'tok/s':>9}")
+    row = [np.mean([step.get(name, 0.0) for step in steps]) * 1000 for name in phases + ('dt',)]
+    print(' '.join(f'{ms:>13.1f}' for ms in row) + f" {np.mean([step['tokens_per_sec'] for step in steps]):>9.0f}")
+
+
+def bench_ddp_scaling(world_sizes=(1, 2, 4), model_type='gpt-micro', block_size=128, batch_size=16, max_iters=20):
+    """ training throughput of distributed data parallel on cpu (gloo), at 1/2/4 processes """
+    print(f"{'-' * 10} DDP scaling: {model_type}, {batch_size} x {block_size} tokens per process per step {'-' * 10}")
+    print(f"{'procs':>6} {'tok/s':>10} {'speedup':>8} {'efficiency':>11}")
+    ctx = mp.get_context('spawn')
+    base = None
+    for world_size in world_sizes:
+        results = ctx.SimpleQueue()
+        mp.spawn(_ddp_worker, args=(world_size, 29500 + world_size, model_type, block_size, batch_size, max_iters,
+                                    results), nprocs=world_size)
+        tokens_per_sec = results.get()
+        base = base or tokens_per_sec
+        speedup = tokens_per_sec / base
+        print(f"{world_size:>6} {tokens_per_sec:>10.1f} {speedup:>7.2f}x {speedup / world_size:>10.0%}")
+
+
+def bench_forward_loss(model_type='gpt-micro', block_size=256, batch_size=16, repeats=5):
+    """ per step overhead of the loss and mask path of GPT.forward over the head, and last position scoring, on CPU """
+    print(f"{'-' * 10} Forward loss path: {model_type}, batch {batch_size} x {block_size}, vocab {VOCAB_SIZE} {'-' * 10}")
+    set_seed(3407)
+    model = build_model(model_type, block_size=block_size)
+    idx = torch.randint(VOCAB_SIZE, (batch_size, block_size))
+    mask = (torch.rand(batch_size, block_size) > 0.1).float()
+    logits = torch.randn(batch_size, block_size, VOCAB_SIZE, requires_grad=True)
+
+    def sliced_loss():
+        # what forward used to do: copy the shifted logits and targets, scale by the float mask and
+        # check on the host that every row has a target, which waits for the loss to be computed
+        flat = logits[:, :-1, :].contiguous().view(-1, VOCAB_SIZE)
+        targets = idx[:, 1:].contiguous().view(-1)
+        loss = F.cross_entropy(flat, targets, reduction='none').view(batch_size, -1) * mask[:, 1:].contiguous()
+        assert 0 not in mask.sum(dim=1)
+        return (loss / mask.sum(dim=1, keepdim=True)).sum() / batch_size
+
+    def ignore_index_loss():
+        # what it does now: masked targets are IGNORE_INDEX and padded on the right, the logits stay as they are
+        targets = F.pad(idx.masked_fill(mask == 0, -100)[:, 1:], (0, 1), value=-100)
+        loss = F.cross_entropy(logits.flatten(0, 1), targets.flatten(), reduction='none').view(batch_size, -1)
+        tokens = (targets != -100).sum(dim=1)
+        return (loss.sum(dim=1) / tokens.clamp(min=1)).sum() / (tokens > 0).sum().clamp(min=1)
+
+    print(f"{'loss path':>22} {'fwd ms':>8} {'fwd+bwd ms':>11} {'peak MB':>8}")
+    for name, fn in [('sliced + float mask', sliced_loss), ('ignore_index', ignore_index_loss)]:
+        forward = time_it(lambda: [fn() for _ in range(repeats)]) / repeats * 1000
+        backward = time_it(lambda: [fn().backward() for _ in range(repeats)]) / repeats * 1000
+        print(f"{name:>22} {forward:>8.2f} {backward:>11.2f} {measure_peak_mb(lambda: fn().backward()):>8.1f}")
+
+    # scoring the last token of every sequence: the whole head vs. only the last position
+    last = torch.zeros(batch_size, block_size)
+    last[:, -1] = 1
+    print(f"{'scoring':>22} {'ms':>8} {'peak MB':>8}")
+    with torch.no_grad():
+        for name, fn in [('mask, all positions', lambda: model(idx, idx, last)),
+                         ('last_only', lambda: model(idx, idx, last_only=True))]:
+            print(f"{name:>22} {time_it(fn) * 1000:>8.1f} {measure_peak_mb(fn):>8.1f}")
+
+
+def bench_activation_checkpointing(n_layers=(6, 12, 24), n_head=8, n_embd=256, block_size=512, batch_size=4,
+                                   settings=(None, 'attn', 4, 2, 'all')):
+    """ peak memory vs. step time of a training step when recomputing blocks in backward, on CPU """
+    print(f"{'-' * 10} Activation checkpointing: n_embd {n_embd}, batch {batch_size} x {block_size} {'-' * 10}")
+    print(f"{'n_layer':>8} {'checkpointing':>14} {'saved MB':>9} {'peak MB':>8} {'step ms':>8} {'max |grad diff|':>16}")
+    idx = torch.randint(VOCAB_SIZE, (batch_size, block_size))
+    for n_layer in n_layers:
+        reference = None
+        for checkpointing in settings:
+            set_seed(3407)
+            # the chunked loss keeps the 50257 wide logits from drowning out the activations of the blocks
+            model = build_model(None, block_size=block_size, n_layer=n_layer, n_head=n_head, n_embd=n_embd,
+                                loss_impl='chunked', loss_chunk_size=128, activation_checkpointing=checkpointing)
+            model.train()
+
+            def step():
+                model.zero_grad(set_to_none=True)
+                _, loss = model(idx, idx)
+                loss.backward()
+
+            # same seed, same dropout masks: the gradients should match storing everything exactly
+            set_seed(3407)
+            step()
+            grads = [p.grad.clone() for p in model.parameters()]
+            reference = reference or grads
+            diff = max((g - r).abs().max().item() for g, r in zip(grads, reference))
+            # what the forward keeps for backward is exact (but for the input each checkpointed block holds on to),
+            # the peak of the process is noisier, the allocator keeps some of the memory freed by earlier runs
+            saved = saved_activations_mb(lambda: model(idx, idx), model)
+            peak = measure_peak_mb(step)
+            ms = time_it(step, repeats=2) * 1000
+            print(f"{n_layer:>8} {str(checkpointing):>14} {saved:>9.1f} {peak:>8.1f} {ms:>8.1f} {diff:>16.2e}")
+
+
+if __name__ == '__main__':
+    # KV-cache incremental decoding vs. recomputing the full context
+    bench_kv_cache()
+
+    # fused scaled-dot-product attention vs. the explicit attention matrix
+    bench_attention_backends()
+
+    # eager vs. torch.compile'd training and decode steps
+    bench_compile()
+
+    # tying lm_head to the token embedding
+    bench_tie_weights()
+
+    # memory efficient losses for the 50257 token lm head
+    bench_loss_impl()
+
+    # speculative decoding of a gpt-2 with a smaller gpt-2 as the draft
+    bench_speculative()
+
+    # vectorized sampling filters and batched beam search
+    bench_decoding()
+
+    # int8 dynamic and weight-only quantization of a gpt-2 for inference
+    bench_quantize()
+
+    # dev perplexity over overlapping sliding windows of the token stream
+    bench_stream_eval()
+
+    # continuous batching inference server under N concurrent clients
+    bench_server()
+
+    # heap based bpe merges vs. the classic quadratic loop
+    bench_bpe_merge()
+
+    # background prefetching of training batches vs. fetching them on the critical path
+    bench_prefetch()
+
+    # length bucketed, token budget and segment packed batches of the wikitext chunks
+    bench_bucketing()
+
+    # per-phase timing of a training step from the metrics sink
+    bench_step_breakdown()
+
+    # distributed data parallel training throughput at 1/2/4 processes
+    bench_ddp_scaling()
+
+    # the ignore_index loss and mask path of the forward pass vs. the sliced, float masked one
+    bench_forward_loss()
+
+    # recomputing the blocks (or their attention) in backward instead of storing their activations
+    bench_activation_checkpointing()
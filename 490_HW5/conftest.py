@@ -0,0 +1 @@
+# pytest puts the directory of this file on sys.path, so the tests import gpt (and data) like main.py does
@@ -1,8 +1,11 @@
+import os
+
+import numpy as np
 import torch
 from datasets import load_dataset
 from gpt.bpe import BPETokenizer
 from tqdm import tqdm
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from torch.nn.utils.rnn import pad_sequence
 
 bpe_tokenizer = BPETokenizer()
@@ -16,8 +19,16 @@ def load_data():
 
     return train_dataset, dev_dataset
 
-def tokenize_data(raw_data, tokenizer):
-    tokenized_data = [tokenizer(x).view(-1) for x in tqdm(raw_data['text'])]
+def tokenize_data(raw_data, tokenizer, chunk_size=20000):
+    texts = raw_data['text']
+    tokenized_data = []
+    # batches of lines are encoded in parallel and concatenated into one flat tensor per batch,
+    # that every line's token tensor is a view into (never padded, and smaller than lists of ints)
+    for i in tqdm(range(0, len(texts), chunk_size)):
+        batch_ids = tokenizer.encoder.encode_batch(texts[i:i + chunk_size])
+        flat = torch.tensor([token for ids in batch_ids for token in ids], dtype=torch.long)
+        tokenized_data.extend(torch.split(flat, [len(ids) for ids in batch_ids]))
+    print(f"bpe cache hit rate: {tokenizer.encoder.cache.hit_rate:.2%}")
     return tokenized_data
 
 def prepare_data(tokenized_data, block_size):
@@ -50,16 +61,143 @@ class WikiTextDataset(Dataset):
     def __getitem__(self, idx):
         return torch.LongTensor(self.data[idx])
 
+    def token_stream(self):
+        """ all the chunks, in order, as one stream of tokens """
+        return torch.cat([torch.as_tensor(example) for example in self.data])
+
+
+class SegmentPackedWikiTextDataset(WikiTextDataset):
+    """
+    Rows of up to block_size tokens, each packing several examples, with the segment ids
+    (1, 2, ... per example) that tell the model where one example ends and the next begins.
+    """
+    def __init__(self, data, block_size):
+        rows, segment_ids = pack_examples(data, block_size)
+        super().__init__(rows, block_size)
+        self.segment_ids = segment_ids
+
+    def __getitem__(self, idx):
+        return self.data[idx], self.segment_ids[idx]
+
+    def token_stream(self):
+        raise TypeError("the rows are packed out of order, stream the WikiTextDataset of the same chunks instead")
+
+
+def pack_examples(examples, block_size):
+    """
+    pack the examples into rows of at most block_size tokens, best fit decreasing: longest first, each
+    into the fullest row that still has room for it. Returns the rows and their segment ids.
+    """
+    order = sorted(range(len(examples)), key=lambda i: len(examples[i]), reverse=True)
+    groups = []
+    # rows_with_room[r] are the rows with exactly r free tokens
+    rows_with_room = [[] for _ in range(block_size + 1)]
+    for i in order:
+        example = torch.as_tensor(examples[i])
+        room = next((r for r in range(len(example), block_size) if rows_with_room[r]), None)
+        if room is None:
+            row, room = len(groups), block_size
+            groups.append([])
+        else:
+            row = rows_with_room[room].pop()
+        groups[row].append(example)
+        rows_with_room[room - len(example)].append(row)
+    rows = [torch.cat(group) for group in groups]
+    segment_ids = [torch.cat([torch.full((len(x),), i + 1) for i, x in enumerate(group)]) for group in groups]
+    return rows, segment_ids
+
+
+class MemmapWikiTextDataset(Dataset):
+    """
+    Serves fixed block_size windows out of a flat token stream that was tokenized once by
+    preprocess_to_disk, straight from a memory map: no tokenization at startup and no padding.
+    The lines are separated by <|endoftext|>, so a window that spans two of them sees where one ends.
+    """
+    def __init__(self, path_prefix, block_size):
+        self.path_prefix = path_prefix
+        self.block_size = block_size
+        # two bytes per uint16 token
+        self.num_tokens = os.path.getsize(path_prefix + '.bin') // 2
+        self._tokens = None
+
+    @property
+    def tokens(self):
+        # mapped lazily so that every dataloader worker opens its own map
+        if self._tokens is None:
+            self._tokens = np.memmap(self.path_prefix + '.bin', dtype=np.uint16, mode='r', shape=(self.num_tokens,))
+        return self._tokens
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tokens'] = None
+        return state
+
+    def __len__(self):
+        return self.num_tokens // self.block_size
+
+    def __getitem__(self, idx):
+        start = idx * self.block_size
+        return torch.from_numpy(self.tokens[start:start + self.block_size].astype(np.int64))
+
+    def token_stream(self):
+        """ the whole token stream, in memory """
+        return torch.from_numpy(self.tokens.astype(np.int64))
+
+
+def preprocess_to_disk(raw_data, path_prefix, tokenizer, chunk_size=20000):
+    """
+    tokenize raw_data once and write it as a flat uint16 token stream to {path_prefix}.bin,
+    with an <|endoftext|> token between every two lines
+    """
+    assert len(tokenizer.encoder.encoder) <= 2**16, "token ids must fit in uint16"
+    os.makedirs(os.path.dirname(path_prefix) or '.', exist_ok=True)
+    separator = np.array([tokenizer.encoder.encoder['<|endoftext|>']], dtype=np.uint16).tobytes()
+    first = True
+    # write to a temporary file first, so an interrupted run never leaves a half written cache behind
+    texts = raw_data['text']
+    with open(path_prefix + '.bin.tmp', 'wb') as f:
+        for i in tqdm(range(0, len(texts), chunk_size)):
+            for ids in tokenizer.encoder.encode_batch(texts[i:i + chunk_size]):
+                # drop 0 & 1 length examples, just like prepare_data
+                if len(ids) <= 1:
+                    continue
+                if not first:
+                    f.write(separator)
+                f.write(np.array(ids, dtype=np.uint16).tobytes())
+                first = False
+    os.replace(path_prefix + '.bin.tmp', path_prefix + '.bin')
+
+
+def wikitext_cache_prefix(split, cache_dir):
+    # eot: the caches written before the lines were separated by <|endoftext|> must not be picked up
+    return os.path.join(cache_dir, f'wikitext-103-{split}-eot')
+
+
+def create_packed_datasets(block_size, cache_dir=os.path.join(os.path.expanduser('~'), '.cache', 'gpt')):
+    """ memory-mapped train/dev datasets, tokenizing wikitext-103 to cache_dir only the first time """
+    prefixes = [wikitext_cache_prefix(split, cache_dir) for split in ('train', 'validation')]
+    if not all(os.path.exists(prefix + '.bin') for prefix in prefixes):
+        print(f"{'-' * 10} Tokenize Dataset To {cache_dir} {'-' * 10}")
+        for raw_data, prefix in zip(load_data(), prefixes):
+            preprocess_to_disk(raw_data, prefix, bpe_tokenizer)
+
+    train_dataset = MemmapWikiTextDataset(prefixes[0], block_size)
+    dev_dataset = MemmapWikiTextDataset(prefixes[1], block_size)
+
+    return train_dataset, dev_dataset
+
 
-def create_datasets(train_data, dev_data, block_size):
+def create_datasets(train_data, dev_data, block_size, segment_pack=False):
+    """ the block_size chunks of every line, padded per batch, or with segment_pack several of them per row """
     train_tokenized = tokenize_data(train_data, bpe_tokenizer)
     dev_tokenized = tokenize_data(dev_data, bpe_tokenizer)
 
     train_preprocessed = prepare_data(train_tokenized, block_size)
     dev_preprocessed = prepare_data(dev_tokenized, block_size)
 
-    train_dataset = WikiTextDataset(train_preprocessed, block_size)
-    dev_dataset = WikiTextDataset(dev_preprocessed, block_size)
+    dataset_class = SegmentPackedWikiTextDataset if segment_pack else WikiTextDataset
+    train_dataset = dataset_class(train_preprocessed, block_size)
+    dev_dataset = dataset_class(dev_preprocessed, block_size)
 
     return train_dataset, dev_dataset
 
@@ -74,5 +212,114 @@ def collate_fn(batch):
     return batch_ids, labels, mask
 
 
-def create_dataloader(dataset, batch_size, shuffle=True):
-    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_fn)
+def segment_collate_fn(batch):
+    # pad the rows of segment packed examples, the padding is segment 0
+    batch_ids = pad_sequence([ids for ids, _ in batch], batch_first=True, padding_value=PAD_ID)
+    segment_ids = pad_sequence([segments for _, segments in batch], batch_first=True, padding_value=0)
+    mask = (segment_ids != 0).float()
+    return batch_ids, batch_ids.clone(), mask, segment_ids
+
+
+def packed_collate_fn(batch):
+    # every window is exactly block_size real tokens, so nothing needs padding or masking
+    batch_ids = torch.stack(batch)
+    mask = torch.ones(batch_ids.shape, dtype=torch.float32)
+    return batch_ids, batch_ids, mask
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches of similar length sequences, so that collate_fn pads them (and the masked loss throws
+    away) as little as possible. Every epoch the sequences are shuffled, cut into pools of pool_size,
+    every pool is sorted by length and cut into batches, and the order of the batches is shuffled:
+    the batches hold different sequences every epoch, but each one only spans a narrow range of lengths.
+
+    A batch holds batch_size sequences, or with max_tokens as many as fit into max_tokens tokens once
+    padded to the longest of them, so short sequences come in large batches and long ones in small.
+    With num_replicas > 1 every rank iterates over its own share of the batches (the same number on
+    each), and like a DistributedSampler every rank must use the same seed and call set_epoch.
+    """
+    def __init__(self, lengths, batch_size=None, max_tokens=None, shuffle=True, pool_size=2**16, seed=0,
+                 num_replicas=1, rank=0):
+        assert (batch_size is None) != (max_tokens is None), "batch by either batch_size or max_tokens"
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        """ the batches (lists of dataset indices) of all ranks in the current epoch """
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        n = len(self.lengths)
+        order = torch.randperm(n, generator=generator) if self.shuffle else torch.arange(n)
+        batches = []
+        for pool in torch.split(order, self.pool_size):
+            # a stable sort, so that sequences of equal length stay in their random order
+            _, ix = torch.sort(self.lengths[pool], stable=True)
+            pool = pool[ix]
+            if self.max_tokens is None:
+                batches.extend(pool.split(self.batch_size))
+                continue
+            # the pool is sorted, so every sequence added is the longest of its batch so far
+            start = 0
+            for end, length in enumerate(self.lengths[pool].tolist()):
+                if end > start and (end - start + 1) * length > self.max_tokens:
+                    batches.append(pool[start:end])
+                    start = end
+            batches.append(pool[start:])
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator)]
+        return [batch.tolist() for batch in batches]
+
+    def __iter__(self):
+        batches = self.batches()
+        # wrap around so that every rank gets the same number of batches
+        batches += batches[:-len(batches) % self.num_replicas]
+        return iter(batches[self.rank::self.num_replicas])
+
+    def __len__(self):
+        return -(-len(self.batches()) // self.num_replicas)
+
+
+def padding_waste(batches, lengths):
+    """ the fraction of the tokens in the padded batches (lists of dataset indices) that are padding """
+    lengths = torch.as_tensor(lengths)
+    real = padded = 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        real += batch_lengths.sum().item()
+        padded += len(batch) * batch_lengths.max().item()
+    return 1 - real / padded
+
+
+def create_dataloader(dataset, batch_size, shuffle=True, num_workers=0, pin_memory=False, bucket=False,
+                      max_tokens=None, seed=0):
+    """
+    a loader over dataset in batches of batch_size sequences. With bucket the (padded) batches group
+    sequences of similar length, and with max_tokens they hold about max_tokens tokens each instead,
+    see BucketBatchSampler. Its seed only matters outside of a Trainer, which reseeds it with its data_seed
+    """
+    if isinstance(dataset, MemmapWikiTextDataset):
+        collate = packed_collate_fn
+    elif isinstance(dataset, SegmentPackedWikiTextDataset):
+        collate = segment_collate_fn
+    else:
+        collate = collate_fn
+    if bucket or max_tokens is not None:
+        assert isinstance(dataset, WikiTextDataset), "only the padded datasets have sequences of different lengths"
+        lengths = [len(example) for example in dataset.data]
+        batch_sampler = BucketBatchSampler(lengths, None if max_tokens else batch_size, max_tokens, shuffle, seed=seed)
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate, num_workers=num_workers,
+                          pin_memory=pin_memory)
+    # with num_workers > 0 the batches are collated in worker processes, pinned if asked to
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate,
+                      num_workers=num_workers, pin_memory=pin_memory)
@@ -9,11 +9,18 @@ set_seed(3407)
 use_mingpt = True # use minGPT or huggingface/transformers model?
 model_type = 'gpt2-xl'
 device = 'cuda'
+_tokenizers = {}
+
+def get_tokenizer():
+    # building a tokenizer loads the whole bpe vocabulary, so do it once and share it across calls
+    if use_mingpt not in _tokenizers:
+        _tokenizers[use_mingpt] = BPETokenizer() if use_mingpt else GPT2Tokenizer.from_pretrained(model_type)
+    return _tokenizers[use_mingpt]
 
 def generate(model, prompt='', num_samples=10, steps=20, do_sample=True):
     # tokenize the input prompt into integer input sequence
+    tokenizer = get_tokenizer()
     if use_mingpt:
-        tokenizer = BPETokenizer()
         if prompt == '':
             # to create unconditional samples...
             # manually create a tensor with only the special <|endoftext|> token
@@ -22,7 +29,6 @@ def generate(model, prompt='', num_samples=10, steps=20, do_sample=True):
         else:
             x = tokenizer(prompt).to(device)
     else:
-        tokenizer = GPT2Tokenizer.from_pretrained(model_type)
         if prompt == '':
             # to create unconditional samples...
             # huggingface/transformers tokenizer special cases these strings
@@ -10,6 +10,10 @@ going on.
 
 import os
 import json
+import heapq
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
 import regex as re
 import requests
 
@@ -59,9 +63,59 @@ def get_pairs(word):
         prev_char = char
     return pairs
 
+class LRUCache:
+    """
+    A size-bounded memo that evicts the least recently used entry once it is full, and keeps
+    count of its hits and misses so we can tell how well it works on a given corpus.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        """ the cached value of key (marking it as recently used), or None """
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+# the Encoder of each process pool worker, set once by _init_worker
+_worker_encoder = None
+
+def _init_worker(encoder):
+    global _worker_encoder
+    _worker_encoder = encoder
+
+def _encode_chunk(texts):
+    """ encode texts in a worker, also returning the bpe cache hits/misses this took """
+    cache = _worker_encoder.cache
+    hits, misses = cache.hits, cache.misses
+    encoded = [_worker_encoder.encode(text) for text in texts]
+    return encoded, cache.hits - hits, cache.misses - misses
+
 class Encoder:
 
-    def __init__(self, encoder, bpe_merges):
+    def __init__(self, encoder, bpe_merges, cache_size=2**17, merge_engine='heap'):
         # byte encoder/decoder
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v:k for k, v in self.byte_encoder.items()}
@@ -70,6 +124,10 @@ class Encoder:
         self.decoder = {v:k for k,v in self.encoder.items()}
         # bpe merge list that defines the bpe "tree", of tuples (a,b) that are to merge to token ab
         self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
+        self.bpe_merges = list(bpe_merges)
+        # how bpe() applies the merges: 'heap' (O(n log n)) or 'classic' (the reference loop)
+        assert merge_engine in ('heap', 'classic')
+        self.merge_engine = merge_engine
         # the splitting pattern used for pre-tokenization
         # Should haved added re.IGNORECASE so BPE merges can happen for capitalized versions of contractions <-- original openai comment
         """
@@ -90,7 +148,18 @@ class Encoder:
         - we then separate out strings into consecutive chunks of 1) letters, 2) numbers, 3) non-letter-numbers, 4) whitespaces
         """
         self.pat = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
-        self.cache = {}
+        self.cache = LRUCache(cache_size)
+        # process pool used by encode_batch, created on first use and then kept around
+        self._pool = None
+        self._pool_workers = None
+
+    def __getstate__(self):
+        # process pool workers get a copy of the encoder: with an empty cache, and without the pool
+        state = self.__dict__.copy()
+        state['cache'] = LRUCache(self.cache.maxsize)
+        state['_pool'] = None
+        state['_pool_workers'] = None
+        return state
 
     def bpe(self, token):
         """
@@ -101,8 +170,9 @@ class Encoder:
         # token is a string of one individual 'word', after byte encoding, e.g. 'Ġthere'
 
         # memoization, for efficiency
-        if token in self.cache:
-            return self.cache[token]
+        cached = self.cache.get(token)
+        if cached is not None:
+            return cached
 
         word = tuple(token) # individual characters that make up the token, in a tuple
         pairs = get_pairs(word) # get all bigrams
@@ -110,6 +180,25 @@ class Encoder:
         if not pairs:
             return token
 
+        if self.merge_engine == 'heap':
+            word = self._merge_heap(word)
+        else:
+            word = self._merge_classic(word, pairs)
+
+        # concat all words into a string, and use ' ' as the separator. Note that
+        # by now all characters have been byte encoded, guaranteeing that ' ' is
+        # not used in the actual data and is a 'special' delimiter character
+        word = ' '.join(word)
+
+        # cache the result and return
+        self.cache.put(token, word)
+        return word
+
+    def _merge_classic(self, word, pairs):
+        """
+        the reference merge loop: rescan all bigrams for the lowest ranked one after every merge,
+        which is quadratic in the length of the word
+        """
         while True:
 
             # find the next lowest rank bigram that can be merged
@@ -148,16 +237,55 @@ class Encoder:
                 break
             else:
                 pairs = get_pairs(word)
-
-        # concat all words into a string, and use ' ' as the separator. Note that
-        # by now all characters have been byte encoded, guaranteeing that ' ' is
-        # not used in the actual data and is a 'special' delimiter character
-        word = ' '.join(word)
-
-        # cache the result and return
-        self.cache[token] = word
         return word
 
+    def _merge_heap(self, word):
+        """
+        the same merges as _merge_classic, in O(n log n): the symbols form a linked list and the
+        candidate bigrams sit in a heap keyed by (rank, position). just like the classic loop, all
+        occurrences of the lowest ranked bigram are merged left to right before any of the bigrams
+        that those merges create are considered.
+        """
+        symbols = list(word) # symbols[i] is None once it was merged into its left neighbour
+        n = len(symbols)
+        prev = list(range(-1, n - 1))
+        nxt = list(range(1, n + 1)) # n marks the end of the word
+        heap = []
+        for i in range(n - 1):
+            rank = self.bpe_ranks.get((symbols[i], symbols[i + 1]))
+            if rank is not None:
+                heap.append((rank, i))
+        heapq.heapify(heap)
+
+        while heap:
+            rank = heap[0][0]
+            first, second = self.bpe_merges[rank]
+            # pop every occurrence of this bigram, they come out left to right
+            positions = []
+            while heap and heap[0][0] == rank:
+                positions.append(heapq.heappop(heap)[1])
+            merged = []
+            for i in positions:
+                j = nxt[i]
+                # skip entries that went stale because one of their symbols was merged already
+                if symbols[i] != first or j == n or symbols[j] != second:
+                    continue
+                symbols[i] = first + second
+                symbols[j] = None
+                nxt[i] = nxt[j]
+                if nxt[j] < n:
+                    prev[nxt[j]] = i
+                merged.append(i)
+            # only now queue the bigrams the merged symbols form with their neighbours
+            for i in merged:
+                for left, right in ((prev[i], i), (i, nxt[i])):
+                    if left >= 0 and right < n:
+                        new_rank = self.bpe_ranks.get((symbols[left], symbols[right]))
+                        if new_rank is not None:
+                            heapq.heappush(heap, (new_rank, left))
+
+        return tuple(symbol for symbol in symbols if symbol is not None)
+
     def encode(self, text):
         """ string goes in, list of integers comes out """
         bpe_idx = []
@@ -177,6 +305,29 @@ class Encoder:
             bpe_idx.extend(token_ix)
         return bpe_idx
 
+    def encode_batch(self, texts, num_workers=None, chunk_size=1000):
+        """
+        list of strings goes in, list of lists of integers comes out. The strings are encoded
+        chunk_size at a time by a pool of num_workers processes (default: one per cpu).
+        """
+        texts = list(texts)
+        num_workers = os.cpu_count() if num_workers is None else num_workers
+        if num_workers <= 1 or len(texts) <= chunk_size:
+            return [self.encode(text) for text in texts]
+        if self._pool is None or self._pool_workers != num_workers:
+            if self._pool is not None:
+                self._pool.shutdown()
+            self._pool = ProcessPoolExecutor(num_workers, initializer=_init_worker, initargs=(self,))
+            self._pool_workers = num_workers
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        out = []
+        for encoded, hits, misses in self._pool.map(_encode_chunk, chunks):
+            out.extend(encoded)
+            # fold the workers' lookups into our cache statistics, so hit_rate covers the whole corpus
+            self.cache.hits += hits
+            self.cache.misses += misses
+        return out
+
     def encode_and_show_work(self, text):
         """ debugging function, same as encode but returns all intermediate work """
         bpe_idx = []
@@ -260,16 +411,29 @@ class BPETokenizer:
     def __init__(self):
         self.encoder = get_encoder()
 
-    def __call__(self, text, return_tensors='pt'):
+    def __call__(self, text, return_tensors='pt', padding_value=None, num_workers=None):
+        """
+        a single string gives a (1, t) tensor. a list of strings is encoded in parallel and gives a
+        (b, max_t) tensor padded with padding_value (default <|endoftext|>), plus the (b,) lengths
+        """
         # PyTorch only; here because we want to match huggingface/transformers interface
         assert return_tensors == 'pt'
-        # single string input for now, in the future potentially a list of strings
-        assert isinstance(text, str)
-        # encode and create a "batch dimension" of 1
-        idx = [self.encoder.encode(text)]
-        # wrap into PyTorch tensor
-        out = torch.tensor(idx, dtype=torch.long)
-        return out
+        if isinstance(text, str):
+            # encode and create a "batch dimension" of 1
+            idx = [self.encoder.encode(text)]
+            # wrap into PyTorch tensor
+            out = torch.tensor(idx, dtype=torch.long)
+            return out
+
+        idx = self.encoder.encode_batch(text, num_workers=num_workers)
+        if padding_value is None:
+            padding_value = self.encoder.encoder['<|endoftext|>']
+        lengths = torch.tensor([len(ids) for ids in idx], dtype=torch.long)
+        max_len = int(lengths.max()) if len(idx) else 0
+        out = torch.full((len(idx), max_len), padding_value, dtype=torch.long)
+        # scatter all ids, concatenated in row-major order, into the non-padded positions
+        out[torch.arange(max_len) < lengths.unsqueeze(1)] = torch.tensor([i for ids in idx for i in ids], dtype=torch.long)
+        return out, lengths
 
     def decode(self, idx):
         # ensure a simple 1D tensor for now
@@ -0,0 +1,70 @@
+"""
+Turning the last step logits (b, vocab_size) of a GPT into next tokens, batched over b:
+
+- temperature scaling
+- top_k: sample among the k most likely tokens only
+- top_p (nucleus): sample among the most likely tokens whose probability mass reaches top_p
+- min_p: drop the tokens less likely than min_p times the most likely one
+- repetition_penalty (CTRL, https://arxiv.org/abs/1909.05858): make the tokens already in the
+  sequence less likely, dividing positive logits and multiplying negative ones by the penalty
+
+None of them ever builds a boolean mask over the whole vocabulary per step. With top_k, everything after
+the topk works on the (b, k) candidates alone.
+"""
+
+import torch
+from torch.nn import functional as F
+
+# -----------------------------------------------------------------------------
+
+def apply_repetition_penalty(logits, idx, penalty):
+    """ the logits (b, vocab_size) with every token that appears in idx (b, t) penalized """
+    score = logits.gather(1, idx)
+    score = torch.where(score < 0, score * penalty, score / penalty)
+    return logits.scatter(1, idx, score)
+
+def sample_next_token(logits, temperature=1.0, top_k=None, top_p=None, min_p=None, do_sample=True):
+    """ the next tokens (b, 1) given the last step logits (b, vocab_size), greedy unless do_sample """
+    if not do_sample:
+        # the filters all keep the most likely token, so they can't change the argmax
+        return torch.argmax(logits, dim=-1, keepdim=True)
+    logits = logits / temperature
+    candidates = None
+    if top_k is not None:
+        # topk returns the candidates sorted, which is all top_p needs
+        logits, candidates = torch.topk(logits, min(top_k, logits.size(-1)), dim=-1)
+    elif top_p is not None:
+        logits, candidates = torch.sort(logits, dim=-1, descending=True)
+    probs = F.softmax(logits, dim=-1)
+    if top_p is not None:
+        # keep the shortest prefix of the sorted candidates with a mass of at least top_p
+        # (a token is dropped when the mass before it already suffices, so the first one always stays)
+        probs = probs.masked_fill(probs.cumsum(dim=-1) - probs >= top_p, 0.0)
+    if min_p is not None:
+        probs = probs.masked_fill(probs < min_p * probs.max(dim=-1, keepdim=True).values, 0.0)
+    # multinomial normalizes the remaining mass itself
+    idx_next = torch.multinomial(probs, num_samples=1)
+    return idx_next if candidates is None else candidates.gather(1, idx_next)
+
+def logits_to_probs(logits, temperature=1.0, top_k=None, top_p=None, min_p=None):
+    """
+    the next token distribution (b, vocab_size) of the last step logits (b, vocab_size), with the same
+    filters as sample_next_token, for the callers that need the whole distribution (speculative decoding)
+    """
+    # scale by desired temperature
+    logits = logits / temperature
+    # optionally crop the logits to only the top k options, scattered back into a vocabulary of -inf
+    if top_k is not None:
+        v, ix = torch.topk(logits, min(top_k, logits.size(-1)), dim=-1)
+        logits = torch.full_like(logits, -float('Inf')).scatter(1, ix, v)
+    # apply softmax to convert logits to (normalized) probabilities
+    probs = F.softmax(logits, dim=-1)
+    if top_p is None and min_p is None:
+        return probs
+    if top_p is not None:
+        sorted_probs, order = torch.sort(probs, dim=-1, descending=True)
+        dropped = sorted_probs.cumsum(dim=-1) - sorted_probs >= top_p
+        probs = probs.masked_fill(dropped.scatter(1, order, dropped), 0.0)
+    if min_p is not None:
+        probs = probs.masked_fill(probs < min_p * probs.max(dim=-1, keepdim=True).values, 0.0)
+    return probs / probs.sum(dim=-1, keepdim=True)
@@ -0,0 +1,72 @@
+"""
+Export a GPT to a standalone artifact for inference, loadable without the Python model code:
+
+- TorchScript (torch.jit.trace), a .pt that torch.jit.load (or libtorch from C++) runs
+- torch.export, a .pt2 ExportedProgram that torch.export.load runs
+
+Both map token indices (b, t) to logits (b, t, vocab_size), for any t up to the block size.
+"""
+
+import torch
+import torch.nn as nn
+
+# -----------------------------------------------------------------------------
+
+class LogitsOnly(nn.Module):
+    """ the plain forward of a GPT (no targets, no kv cache) that only returns the logits """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, idx):
+        logits, _ = self.model(idx)
+        return logits
+
+def _example_input(model, batch_size=1, seq_len=None):
+    seq_len = seq_len or model.block_size
+    vocab_size = model.lm_head.out_features
+    device = next(model.parameters()).device
+    return torch.randint(vocab_size, (batch_size, seq_len), device=device)
+
+@torch.no_grad()
+def export_torchscript(model, path, check_len=None):
+    """ trace the model into TorchScript and save it to path, checking the trace against the eager model """
+    model.eval()
+    wrapper = LogitsOnly(model).eval()
+    example = _example_input(model)
+    # check on a shorter sequence too, the trace must not have baked in the example length
+    check = _example_input(model, seq_len=check_len or max(1, model.block_size // 2))
+    traced = torch.jit.trace(wrapper, example, check_inputs=[(example,), (check,)])
+    traced.save(path)
+    return traced
+
+def load_torchscript(path, device='cpu'):
+    return torch.jit.load(path, map_location=device)
+
+@torch.no_grad()
+def export_program(model, path):
+    """ torch.export the model, with a dynamic batch size and sequence length, and save it to path """
+    model.eval()
+    wrapper = LogitsOnly(model).eval()
+    # an example strictly inside the dynamic ranges, at their bounds export would specialize them
+    example = _example_input(model, batch_size=2, seq_len=max(2, model.block_size // 2))
+    max_len = model.block_size
+    if model.transformer.h[0].attn.attn_backend == 'eager':
+        # slicing the causal mask buffer gives a contiguous view only at the full block size, which
+        # export can't trace symbolically, so an eager model is exported for up to block_size - 1 tokens
+        max_len -= 1
+    if hasattr(torch.export, 'Dim'):
+        batch = torch.export.Dim('batch')
+        seq = torch.export.Dim('seq', max=max_len)
+        program = torch.export.export(wrapper, (example,), dynamic_shapes={'idx': {0: batch, 1: seq}})
+    else:
+        # torch 2.1 declared the dynamic dimensions as constraints
+        program = torch.export.export(wrapper, (example,), constraints=[
+            torch.export.dynamic_dim(example, 0), torch.export.dynamic_dim(example, 1) <= max_len])
+    torch.export.save(program, path)
+    return program
+
+def load_program(path):
+    """ an nn.Module running the exported program saved at path """
+    return torch.export.load(path).module()
@@ -0,0 +1,106 @@
+"""
+Memory efficient losses for a language model head with a large vocabulary.
+
+The plain way computes logits = hidden @ weight.T for all N positions at once, an (N, vocab_size)
+tensor (plus its softmax and gradient of the same size) that dominates the memory of a training
+step. These functions take the hidden states and the head weight instead of the logits:
+
+- chunked_cross_entropy is exact. It goes over the positions in chunks, so only one
+  (chunk_size, vocab_size) block of logits exists at a time, and recomputes the blocks in backward
+  instead of keeping them around.
+- sampled_softmax_loss is an approximation for training only. Every position is scored against
+  its target and a shared random sample of num_sampled other tokens, not the whole vocabulary.
+
+Both work for any linear head: hidden (N, C), weight (vocab_size, C) and an optional bias (vocab_size,).
+"""
+
+import torch
+from torch.nn import functional as F
+
+# -----------------------------------------------------------------------------
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """ per position cross entropy of the logits hidden @ weight.T + bias, never materialized in full """
+
+    @staticmethod
+    def forward(ctx, hidden, weight, bias, targets, chunk_size, ignore_index):
+        N = hidden.size(0)
+        # the softmax is computed in (at least) fp32, whatever precision the matmuls run in
+        acc = torch.promote_types(hidden.dtype, torch.float32)
+        losses = hidden.new_empty(N, dtype=acc)
+        lse = hidden.new_empty(N, dtype=acc)
+        # backward runs outside of autocast, it has to recompute the logits in the precision they had here,
+        # or their softmax doesn't match the log-sum-exp saved from them
+        device_type = hidden.device.type
+        ctx.autocast = torch.is_autocast_enabled(device_type)
+        ctx.autocast_dtype = torch.get_autocast_dtype(device_type)
+        for start in range(0, N, chunk_size):
+            end = min(start + chunk_size, N)
+            logits = F.linear(hidden[start:end], weight, bias).to(acc)
+            lse[start:end] = torch.logsumexp(logits, dim=-1)
+            target = targets[start:end].clamp(min=0) # ignored positions index some class, masked below
+            losses[start:end] = lse[start:end] - logits.gather(1, target.unsqueeze(1)).squeeze(1)
+        ignored = targets == ignore_index
+        losses.masked_fill_(ignored, 0.0)
+        ctx.save_for_backward(hidden, weight, bias, targets, lse)
+        ctx.chunk_size = chunk_size
+        ctx.ignore_index = ignore_index
+        return losses
+
+    @staticmethod
+    def backward(ctx, grad_losses):
+        hidden, weight, bias, targets, lse = ctx.saved_tensors
+        N, acc = hidden.size(0), lse.dtype
+        # d loss / d logits = softmax(logits) - onehot(target), scaled by the incoming gradient
+        grad_scale = grad_losses.to(acc).masked_fill(targets == ctx.ignore_index, 0.0)
+        grad_hidden = torch.zeros_like(hidden) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.zeros_like(weight, dtype=acc) if ctx.needs_input_grad[1] else None
+        grad_bias = torch.zeros_like(bias, dtype=acc) if bias is not None and ctx.needs_input_grad[2] else None
+        for start in range(0, N, ctx.chunk_size):
+            end = min(start + ctx.chunk_size, N)
+            h = hidden[start:end]
+            with torch.autocast(hidden.device.type, dtype=ctx.autocast_dtype, enabled=ctx.autocast):
+                logits = F.linear(h, weight, bias).to(acc)
+            grad_logits = torch.exp(logits - lse[start:end].unsqueeze(1))
+            target = targets[start:end].clamp(min=0)
+            grad_logits.scatter_add_(1, target.unsqueeze(1), -torch.ones_like(grad_logits[:, :1]))
+            grad_logits *= grad_scale[start:end].unsqueeze(1)
+            if grad_hidden is not None:
+                grad_hidden[start:end] = (grad_logits @ weight.to(acc)).to(hidden.dtype)
+            if grad_weight is not None:
+                grad_weight += grad_logits.t() @ h.to(acc)
+            if grad_bias is not None:
+                grad_bias += grad_logits.sum(dim=0)
+        if grad_weight is not None:
+            grad_weight = grad_weight.to(weight.dtype)
+        if grad_bias is not None:
+            grad_bias = grad_bias.to(bias.dtype)
+        return grad_hidden, grad_weight, grad_bias, None, None, None
+
+def chunked_cross_entropy(hidden, weight, targets, bias=None, chunk_size=1024, ignore_index=-100):
+    """
+    the cross entropy (N,) of every position of hidden (N, C) against targets (N,), under the head
+    weight (vocab_size, C) and bias, with the same values and gradients as
+    F.cross_entropy(F.linear(hidden, weight, bias), targets, reduction='none', ignore_index=ignore_index)
+    """
+    return ChunkedCrossEntropy.apply(hidden, weight, bias, targets, chunk_size, ignore_index)
+
+def sampled_softmax_loss(hidden, weight, targets, num_sampled, bias=None, ignore_index=-100):
+    """
+    an approximate cross entropy (N,) that normalizes every position over its target and num_sampled
+    tokens drawn uniformly from the vocabulary (shared by all positions). The proposal is uniform, so
+    its log probability is the same for every candidate and cancels out of the softmax.
+    """
+    vocab_size = weight.size(0)
+    target = targets.clamp(min=0)
+    sampled = torch.randint(vocab_size, (num_sampled,), device=hidden.device)
+    target_logits = (hidden * weight[target]).sum(dim=-1)
+    sampled_logits = hidden @ weight[sampled].t()
+    if bias is not None:
+        target_logits = target_logits + bias[target]
+        sampled_logits = sampled_logits + bias[sampled]
+    # a sample that happens to be the target must not compete with it
+    sampled_logits = sampled_logits.masked_fill(sampled.unsqueeze(0) == target.unsqueeze(1), float('-inf'))
+    logits = torch.cat([target_logits.unsqueeze(1), sampled_logits], dim=1).float()
+    losses = torch.logsumexp(logits, dim=-1) - logits[:, 0]
+    return losses.masked_fill(targets == ignore_index, 0.0)
@@ -0,0 +1,110 @@
+"""
+Step level instrumentation for the Trainer: timing the phases of a training step, writing
+one JSON record per step to a JSONL file (so runs can be compared across commits), and
+capturing a torch.profiler window as a Chrome trace.
+"""
+
+import os
+import json
+import time
+import subprocess
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+# -----------------------------------------------------------------------------
+
+def git_commit():
+    """ the commit the code runs from, or None outside of a git checkout """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class StepTimer:
+    """
+    Accumulates wall clock seconds per named phase of a step:
+
+        with timer('forward'):
+            ...
+
+    cuda kernels run asynchronously, so with sync=True the device is synchronized around every
+    phase to charge the kernels to the phase that launched them. The phases also show up as
+    labelled ranges in profiler traces.
+    """
+
+    def __init__(self, sync=False):
+        self.sync = sync
+        self.times = defaultdict(float)
+
+    def reset(self):
+        self.times = defaultdict(float)
+
+    @contextmanager
+    def __call__(self, name):
+        if self.sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+        if self.sync:
+            torch.cuda.synchronize()
+        self.times[name] += time.perf_counter() - start
+
+class JSONLSink:
+    """
+    appends one JSON object per line to path, flushing after each so a crashed run keeps its records.
+    Values may be 0-d tensors, they are read out (and the device waited for) here.
+    """
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.file = open(path, 'a')
+
+    def write(self, record):
+        record = {k: v.item() if isinstance(v, torch.Tensor) else v for k, v in record.items()}
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ProfilerWindow:
+    """
+    Runs torch.profiler over the iterations [start, stop) and writes their Chrome trace
+    (open it in chrome://tracing or https://ui.perfetto.dev) to trace_dir.
+    """
+
+    def __init__(self, start, stop, trace_dir, device, name='trace'):
+        assert 0 <= start < stop
+        self.start, self.stop = start, stop
+        self.trace_dir = trace_dir
+        self.name = name
+        self.activities = [torch.profiler.ProfilerActivity.CPU]
+        if str(device).startswith('cuda'):
+            self.activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = None
+
+    def step_begin(self, iter_num):
+        if iter_num == self.start:
+            self.profiler = torch.profiler.profile(activities=self.activities, record_shapes=True, profile_memory=True)
+            self.profiler.__enter__()
+
+    def step_end(self, iter_num):
+        """ call with the number of the iteration that just finished """
+        if self.profiler is not None and iter_num + 1 >= self.stop:
+            self.close()
+
+    def close(self):
+        if self.profiler is None:
+            return
+        self.profiler.__exit__(None, None, None)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        path = os.path.join(self.trace_dir, f'{self.name}_{self.start}-{self.stop}.json')
+        self.profiler.export_chrome_trace(path)
+        print(f"wrote profiler trace to {path}")
+        self.profiler = None
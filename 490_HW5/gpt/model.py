@@ -2,13 +2,22 @@
 Full definition of a GPT Language Model, all of it in this single file.
 """
 
+import os
+import json
 import math
+import functools
 
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 
 from gpt.utils import CfgNode as CN
+from gpt.loss import chunked_cross_entropy, sampled_softmax_loss
+from gpt.decoding import apply_repetition_penalty, sample_next_token, logits_to_probs
+
+# the target of tokens that are not predicted (the default ignore_index of F.cross_entropy)
+IGNORE_INDEX = -100
 
 # -----------------------------------------------------------------------------
 
@@ -20,6 +29,49 @@ class NewGELU(nn.Module):
     def forward(self, x):
         return 0.5 * x * (1.0 + torch.tanh(math.sqrt(2.0 / math.pi) * (x + 0.044715 * torch.pow(x, 3.0))))
 
+class KVCache:
+    """
+    Keys and values of all previously seen positions for a single attention layer, so that
+    incremental decoding only has to push the newest token(s) through the model. The buffers
+    are allocated once (on first use) with room for max_len positions and filled in place.
+    """
+
+    def __init__(self, max_len):
+        self.max_len = max_len
+        self.k = None
+        self.v = None
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def update(self, k, v):
+        """ append the keys/values (B, nh, T, hs) of the new positions, return those of all positions """
+        B, nh, T, hs = k.size()
+        assert self.length + T <= self.max_len, "kv cache overflow, crop the context first"
+        if self.k is None:
+            self.k = k.new_empty(B, nh, self.max_len, hs)
+            self.v = v.new_empty(B, nh, self.max_len, hs)
+        self.k[:, :, self.length:self.length + T] = k
+        self.v[:, :, self.length:self.length + T] = v
+        self.length += T
+        return self.k[:, :, :self.length], self.v[:, :, :self.length]
+
+    def crop(self, length):
+        """ forget everything past the first `length` positions """
+        self.length = min(self.length, length)
+
+    def reorder(self, index):
+        """ keep the batch rows index (b,) in that order, e.g. the surviving beams or unfinished sequences """
+        if self.k is None:
+            return
+        if index.size(0) == self.k.size(0):
+            # the batch keeps its size (beam search), shuffle the filled positions in place
+            self.k[:, :, :self.length] = self.k[index, :, :self.length]
+            self.v[:, :, :self.length] = self.v[index, :, :self.length]
+        else:
+            self.k, self.v = self.k[index], self.v[index]
+
 class CausalSelfAttention(nn.Module):
     """
     A vanilla multi-head masked self-attention layer with a projection at the end.
@@ -36,22 +88,38 @@ class CausalSelfAttention(nn.Module):
         self.attn_dropout = nn.Dropout(config.attn_pdrop)
         self.resid_dropout = nn.Dropout(config.resid_pdrop)
 
-        # TODO: create a causal mask for attention matrix of shape [config.block_size, config.block_size] (config.block_size is the maximum sequence length)
-        #   The matrix should has 1s in the lower left triangular part (including the diagonal) and 0s in the upper right.
-        #   Name the matrix `causal_mask` and then expand the mask for the batch and head dimensions
-        causal_mask = torch.tril(torch.ones(config.block_size, config.block_size))
-        causal_mask = causal_mask.view(1, 1, config.block_size, config.block_size)
+        # 'eager' materializes the full attention matrix, 'sdpa' routes through the fused
+        # F.scaled_dot_product_attention kernel and needs no mask buffer at all
+        assert config.attn_backend in ('eager', 'sdpa')
+        self.attn_backend = config.attn_backend
+        self.attn_pdrop = config.attn_pdrop
+
+        if self.attn_backend == 'eager':
+            # TODO: create a causal mask for attention matrix of shape [config.block_size, config.block_size] (config.block_size is the maximum sequence length)
+            #   The matrix should has 1s in the lower left triangular part (including the diagonal) and 0s in the upper right.
+            #   Name the matrix `causal_mask` and then expand the mask for the batch and head dimensions
+            causal_mask = torch.tril(torch.ones(config.block_size, config.block_size))
+            causal_mask = causal_mask.view(1, 1, config.block_size, config.block_size)
 
 
-        # your code ends here
-        
-        # register the mask as a buffer so it's not updated as a model parameter
-        # but can still be used in the forward pass & saved to the state_dict
-        self.register_buffer("causal_mask", causal_mask)
+            # your code ends here
+
+            # register the mask as a buffer so it's not updated as a model parameter
+            # but can still be used in the forward pass & saved to the state_dict
+            self.register_buffer("causal_mask", causal_mask)
         self.n_head = config.n_head
         self.n_embd = config.n_embd
 
-    def forward(self, x):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the mask buffer only exists with the eager backend, so let checkpoints move between backends
+        key = prefix + 'causal_mask'
+        if not hasattr(self, 'causal_mask'):
+            state_dict.pop(key, None)
+        elif key not in state_dict:
+            state_dict[key] = self.causal_mask
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, kv_cache=None, attn_mask=None):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # TODO: implement the forward pass of the casual self-attention layer.
@@ -60,11 +128,34 @@ class CausalSelfAttention(nn.Module):
         q= q.view(B, T, self.n_head, C // self.n_head).transpose(1,2)
         v= v.view(B, T, self.n_head, C // self.n_head).transpose(1,2)
 
-        att = (q @ k.transpose(-2,-1)) * (1.0 / math.sqrt(k.size(-1)))
-        att = att.masked_fill(self.causal_mask[:,:,:T,:T]==0, float('inf'))
-        att = F.softmax(att, dim=-1)
-        att = self.attn_dropout(att)
-        y = att @ v
+        # when decoding incrementally, the T new positions also attend to the P cached ones
+        P = 0
+        if kv_cache is not None:
+            P = len(kv_cache)
+            k, v = kv_cache.update(k, v)
+        S = k.size(-2) # P + T
+
+        if self.attn_backend == 'sdpa':
+            dropout_p = self.attn_pdrop if self.training else 0.0
+            if attn_mask is not None:
+                y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+            elif P == 0:
+                y = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, is_causal=True)
+            elif T == 1:
+                # a single new token may attend to every cached position, no mask needed
+                y = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+            else:
+                # is_causal aligns the mask to the top left, but the new queries sit at positions P..S-1
+                attn_mask = torch.ones(T, S, dtype=torch.bool, device=x.device).tril(diagonal=P)
+                y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+        else:
+            att = (q @ k.transpose(-2,-1)) * (1.0 / math.sqrt(k.size(-1)))
+            # an explicit attn_mask (True = may attend) replaces the causal one
+            blocked = self.causal_mask[:,:,P:S,:S]==0 if attn_mask is None else ~attn_mask
+            att = att.masked_fill(blocked, float('-inf'))
+            att = F.softmax(att, dim=-1)
+            att = self.attn_dropout(att)
+            y = att @ v
         y = y.transpose(1,2).contiguous().view(B, T, C)
 
         y= self.resid_dropout(self.c_proj(y))
@@ -73,7 +164,7 @@ class CausalSelfAttention(nn.Module):
 class Block(nn.Module):
     """ an unassuming Transformer block """
 
-    def __init__(self, config):
+    def __init__(self, config, checkpointing=None):
         super().__init__()
         self.ln_1 = nn.LayerNorm(config.n_embd)
         self.attn = CausalSelfAttention(config)
@@ -84,14 +175,97 @@ class Block(nn.Module):
             act     = NewGELU(),
             dropout = nn.Dropout(config.resid_pdrop),
         ))
+        # None, 'block' or 'attn': what is recomputed in backward instead of keeping its activations
+        assert checkpointing in (None, 'block', 'attn')
+        self.checkpointing = checkpointing
+
+    def attnf(self, x, kv_cache=None, attn_mask=None):
+        """ attention forward, from the residual stream to the update of it """
+        return self.attn(self.ln_1(x), kv_cache=kv_cache, attn_mask=attn_mask)
+
+    def mlpf(self, x):
+        """ MLP forward, a method rather than a lambda so the block can be pickled, scripted and compiled """
         m = self.mlp
-        self.mlpf = lambda x: m.dropout(m.c_proj(m.act(m.c_fc(x)))) # MLP forward
+        return m.dropout(m.c_proj(m.act(m.c_fc(x))))
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def _forward(self, x, kv_cache=None, attn_mask=None):
+        x = x + self.attnf(x, kv_cache=kv_cache, attn_mask=attn_mask)
+        x = x + self.mlpf(self.ln_2(x))
+        return x
+
+    def forward(self, x, kv_cache=None, attn_mask=None):
+        if self.checkpointing is None or kv_cache is not None or not (self.training and torch.is_grad_enabled()):
+            return self._forward(x, kv_cache=kv_cache, attn_mask=attn_mask)
+        # only the input is kept, the forward runs again in backward. restoring the rng state
+        # before that makes the recomputed dropout masks the same as the original ones
+        if self.checkpointing == 'block':
+            return checkpoint(self._forward, x, None, attn_mask, use_reentrant=False, preserve_rng_state=True)
+        x = x + checkpoint(self.attnf, x, None, attn_mask, use_reentrant=False, preserve_rng_state=True)
         x = x + self.mlpf(self.ln_2(x))
         return x
 
+def document_positions_and_mask(segment_ids):
+    """
+    for rows packed with several documents, segment_ids (b, t), the position of every token within
+    its document (b, t) and the block diagonal causal attention mask (b, 1, t, t), True = may attend
+    """
+    b, t = segment_ids.size()
+    steps = torch.arange(t, device=segment_ids.device).expand(b, t)
+    starts = F.pad(segment_ids[:, 1:] != segment_ids[:, :-1], (1, 0), value=True)
+    # the step at which the document of every token started, carried forward over the row
+    document_start = torch.where(starts, steps, 0).cummax(dim=1).values
+    causal = torch.ones(t, t, dtype=torch.bool, device=segment_ids.device).tril()
+    attn_mask = (segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1)) & causal
+    return steps - document_start, attn_mask.unsqueeze(1)
+
+def _hf_checkpoint_tensors(model_type):
+    """ the (name, tensor) pairs of the huggingface checkpoint of model_type, read one tensor at a time """
+    try:
+        from huggingface_hub import hf_hub_download
+        from huggingface_hub.utils import EntryNotFoundError
+        from safetensors import safe_open
+    except ImportError:
+        # without safetensors, go through the whole transformers model (in memory all at once)
+        from transformers import GPT2LMHeadModel
+        yield from GPT2LMHeadModel.from_pretrained(model_type).state_dict().items()
+        return
+
+    try:
+        files = [hf_hub_download(model_type, 'model.safetensors')]
+    except EntryNotFoundError:
+        # a sharded checkpoint, the index maps every tensor to the shard holding it
+        with open(hf_hub_download(model_type, 'model.safetensors.index.json')) as f:
+            shards = sorted(set(json.load(f)['weight_map'].values()))
+        files = [hf_hub_download(model_type, shard) for shard in shards]
+    for file in files:
+        # safe_open memory maps the shard, get_tensor reads only the bytes of that one tensor
+        with safe_open(file, framework='pt') as f:
+            for k in f.keys():
+                yield k, f.get_tensor(k)
+
+def _convert_hf_checkpoint(model_type):
+    """ the huggingface checkpoint of model_type as a state_dict of GPT """
+    transposed = ['attn.c_attn.weight', 'attn.c_proj.weight', 'mlp.c_fc.weight', 'mlp.c_proj.weight']
+    sd = {}
+    for k, v in _hf_checkpoint_tensors(model_type):
+        if k.endswith('.attn.bias') or k.endswith('.attn.masked_bias'):
+            continue # the causal mask buffers of the huggingface model
+        if not k.startswith(('transformer.', 'lm_head.')):
+            k = 'transformer.' + k # the safetensors checkpoints store the GPT2Model without its prefix
+        if any(k.endswith(w) for w in transposed):
+            # basically the openai checkpoints use a "Conv1D" module, but we only want to use a vanilla nn.Linear.
+            # this means that we have to transpose these weights when we import them
+            v = v.t().contiguous()
+        sd[k] = v
+    # the checkpoints leave out the lm_head, it is the token embedding
+    sd.setdefault('lm_head.weight', sd['transformer.wte.weight'])
+    return sd
+
+@functools.lru_cache(maxsize=None)
+def _compiled_forward(backend):
+    """ GPT.forward compiled with backend, shared by all models, see GPT.compile_decode """
+    return torch.compile(GPT.forward, backend=backend, dynamic=True)
+
 class GPT(nn.Module):
     """ GPT Language Model """
 
@@ -110,13 +284,34 @@ class GPT(nn.Module):
         C.embd_pdrop = 0.1
         C.resid_pdrop = 0.1
         C.attn_pdrop = 0.1
+        # attention implementation: 'eager' (explicit T x T attention matrix) or 'sdpa' (fused kernel)
+        C.attn_backend = 'eager'
+        # share one vocab_size x n_embd matrix between the token embedding and the output layer
+        C.tie_weights = False
+        # how the training loss is computed from the lm_head: 'full' materializes all the logits,
+        # 'chunked' computes the exact same loss loss_chunk_size positions at a time, and 'sampled'
+        # approximates the softmax over sampled_softmax_k random tokens while training (and is
+        # exact like 'chunked' in eval mode). the last two return no logits along with the loss
+        C.loss_impl = 'full'
+        C.loss_chunk_size = 1024
+        C.sampled_softmax_k = 1024
+        # recompute the forward of blocks in backward instead of storing their activations while
+        # training: None (store everything), 'all' blocks, every k-th block for an int k, or 'attn'
+        # (only the attention of every block, whose eager T x T matrices are the largest activations)
+        C.activation_checkpointing = None
         return C
 
     def __init__(self, config):
         super().__init__()
         assert config.vocab_size is not None
         assert config.block_size is not None
+        assert config.loss_impl in ('full', 'chunked', 'sampled')
+        checkpointing = config.activation_checkpointing
+        assert checkpointing in (None, 'all', 'attn') or (type(checkpointing) is int and checkpointing > 0)
         self.block_size = config.block_size
+        self.loss_impl = config.loss_impl
+        self.loss_chunk_size = config.loss_chunk_size
+        self.sampled_softmax_k = config.sampled_softmax_k
 
         type_given = config.model_type is not None
         params_given = all([config.n_layer is not None, config.n_head is not None, config.n_embd is not None])
@@ -145,10 +340,12 @@ class GPT(nn.Module):
             wte = nn.Embedding(config.vocab_size, config.n_embd),
             wpe = nn.Embedding(config.block_size, config.n_embd),
             drop = nn.Dropout(config.embd_pdrop),
-            h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
+            h = nn.ModuleList([Block(config, self._block_checkpointing(checkpointing, i)) for i in range(config.n_layer)]),
             ln_f = nn.LayerNorm(config.n_embd),
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
+        if config.tie_weights:
+            self.lm_head.weight = self.transformer.wte.weight
 
         # init all weights, and apply a special scaled init to the residual projections, per GPT-2 paper
         self.apply(self._init_weights)
@@ -160,6 +357,20 @@ class GPT(nn.Module):
         n_params = sum(p.numel() for p in self.transformer.parameters())
         print("number of parameters: %.2fM" % (n_params/1e6,))
 
+        # the torch.compile backend of the single token decode step of generate, see compile_decode
+        self._decode_backend = None
+        # proposed/accepted token counts of the last generate_speculative call
+        self.speculative_stats = None
+
+    @staticmethod
+    def _block_checkpointing(checkpointing, i):
+        """ what block i recomputes in backward under the activation_checkpointing config """
+        if checkpointing == 'attn':
+            return 'attn'
+        if checkpointing == 'all' or (type(checkpointing) is int and i % checkpointing == 0):
+            return 'block'
+        return None
+
     def _init_weights(self, module):
         if isinstance(module, nn.Linear):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
@@ -172,43 +383,41 @@ class GPT(nn.Module):
             torch.nn.init.ones_(module.weight)
 
     @classmethod
-    def from_pretrained(cls, model_type):
+    def from_pretrained(cls, model_type, cache_dir=os.path.join(os.path.expanduser('~'), '.cache', 'gpt')):
         """
-        Initialize a pretrained GPT model by copying over the weights
-        from a huggingface/transformers checkpoint.
+        Initialize a pretrained GPT model from a huggingface/transformers checkpoint.
+
+        The model is built on the meta device, so nothing is allocated or randomly initialized, and
+        the checkpoint tensors are then assigned in place of the meta parameters. The first load
+        converts the checkpoint to our layout one tensor at a time and caches it in cache_dir, later
+        loads memory map the cache, so the weights are only paged in when they are first used.
         """
         assert model_type in {'gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'}
-        from transformers import GPT2LMHeadModel
 
-        # create a from-scratch initialized minGPT model
         config = cls.get_default_config()
         config.model_type = model_type
         config.vocab_size = 50257 # openai's model vocabulary
         config.block_size = 1024  # openai's model block_size
-        model = GPT(config)
-        sd = model.state_dict()
-
-        # init a huggingface/transformers model
-        model_hf = GPT2LMHeadModel.from_pretrained(model_type)
-        sd_hf = model_hf.state_dict()
-
-        # copy while ensuring all of the parameters are aligned and match in names and shapes
-        keys = [k for k in sd_hf if not k.endswith('attn.masked_bias')] # ignore these
-        transposed = ['attn.c_attn.weight', 'attn.c_proj.weight', 'mlp.c_fc.weight', 'mlp.c_proj.weight']
-        # basically the openai checkpoints use a "Conv1D" module, but we only want to use a vanilla nn.Linear.
-        # this means that we have to transpose these weights when we import them
-        assert len(keys) == len(sd)
-        for k in keys:
-            if any(k.endswith(w) for w in transposed):
-                # special treatment for the Conv1D weights we need to transpose
-                assert sd_hf[k].shape[::-1] == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k].t())
-            else:
-                # vanilla copy over the other parameters
-                assert sd_hf[k].shape == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k])
+        config.tie_weights = True # gpt-2 shares its token embedding with the output layer
+        with torch.device('meta'):
+            model = GPT(config)
+
+        path = os.path.join(cache_dir, f'{model_type}.pt')
+        if not os.path.exists(path):
+            os.makedirs(cache_dir, exist_ok=True)
+            # write to a temporary file first, so an interrupted conversion never leaves a broken cache behind
+            torch.save(_convert_hf_checkpoint(model_type), path + '.tmp')
+            os.replace(path + '.tmp', path)
+        sd = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+        # strict, so the names and shapes of all the parameters must match
+        model.load_state_dict(sd, assign=True)
+        # assigning gave wte and lm_head a parameter each (on the same storage), tie them again
+        model.lm_head.weight = model.transformer.wte.weight
+        # the causal masks are not part of the checkpoint, so they are still on the meta device
+        for block in model.transformer.h:
+            if block.attn.attn_backend == 'eager':
+                block.attn.causal_mask = torch.tril(torch.ones(config.block_size, config.block_size)) \
+                    .view(1, 1, config.block_size, config.block_size)
 
         return model
 
@@ -241,6 +450,11 @@ class GPT(nn.Module):
                     # weights of blacklist modules will NOT be weight decayed
                     no_decay.add(fpn)
 
+        # a tied lm_head.weight is the very tensor transformer.wte.weight, which named_parameters()
+        # only lists under the latter, so it is regularized like the embedding it is
+        if self.lm_head.weight is self.transformer.wte.weight:
+            decay.discard('lm_head.weight')
+
         # validate that we considered every parameter
         param_dict = {pn: p for pn, p in self.named_parameters()}
         inter_params = decay & no_decay
@@ -257,64 +471,373 @@ class GPT(nn.Module):
         optimizer = torch.optim.AdamW(optim_groups, lr=train_config.learning_rate, betas=train_config.betas)
         return optimizer
 
-    def forward(self, idx, targets=None, mask=None):
+    def flops_per_token(self, seq_len):
+        """
+        FLOPs of a training step (forward and backward) per token at sequence length seq_len,
+        6 per parameter plus the attention scores, as in the PaLM paper (appendix B)
+        """
+        # the embeddings are looked up, not multiplied, but the lm_head (tied to wte or not) is a matmul
+        n_params = (sum(p.numel() for p in self.parameters()) - self.transformer.wpe.weight.numel()
+                    - self.transformer.wte.weight.numel() + self.lm_head.weight.numel())
+        n_layer = len(self.transformer.h)
+        n_embd = self.transformer.wte.embedding_dim
+        return 6 * n_params + 12 * n_layer * n_embd * seq_len
+
+    def new_kv_cache(self):
+        """ an empty key/value cache (one KVCache per layer) for incremental decoding """
+        return [KVCache(self.block_size) for _ in self.transformer.h]
+
+    def compile_decode(self, backend='inductor'):
+        """
+        torch.compile the single token decode step of generate. The kv cache grows by one position
+        every step, so it is compiled with dynamic shapes instead of once per cache length.
+        Only the backend is kept on the model, the compiled forward takes the model as an argument,
+        so copies (quantized ones too) decode with their own weights and the model stays picklable.
+        """
+        self._decode_backend = backend
+        return self
+
+    def forward(self, idx, targets=None, mask=None, kv_cache=None, pos=None, attn_mask=None, reduction='mean',
+                segment_ids=None, last_only=False):
+        """
+        idx (b, t) are the token indices; with a kv cache they are only the new tokens that follow
+        the cached ones. pos (b, t) optionally overrides the positions of idx and attn_mask (bool,
+        broadcastable to (b, 1, t, past + t), True = may attend) replaces the causal mask, which lets
+        callers batch sequences that have different lengths.
+        Every position is trained to predict the next token of targets (b, t). Tokens where mask (b, t)
+        is 0, or whose target is IGNORE_INDEX, are not predicted. The loss is the mean over the
+        sequences of their mean token loss, with reduction='sum' it is the summed loss of all predicted
+        tokens instead, for token weighted averages over many batches.
+        segment_ids (b, t) mark the documents packed into every row (numbered 1, 2, ... and 0 for padding).
+        Every document is then treated as a sequence of its own: its tokens only attend within it, its
+        positions start at 0, its first token isn't predicted from the previous document, and the loss
+        is the mean over the documents (instead of the rows) of their mean token loss.
+        With last_only only the last position goes through the lm_head: the logits (b, 1, vocab_size)
+        are those of the token after idx, or with targets those of the last token of targets, whose
+        loss is then the only one (for scoring completions, or decoding).
+        The logits are (b, t, vocab_size), or None when the loss is computed without them (loss_impl).
+        """
         device = idx.device
         b, t = idx.size()
-        assert t <= self.block_size, f"Cannot forward sequence of length {t}, block size is only {self.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device).unsqueeze(0) # shape (1, t)
+        past = len(kv_cache[0]) if kv_cache is not None else 0
+        assert past + t <= self.block_size, f"Cannot forward sequence of length {past + t}, block size is only {self.block_size}"
+        if segment_ids is not None:
+            assert kv_cache is None and pos is None and attn_mask is None, "segment_ids define the positions and mask"
+            pos, attn_mask = document_positions_and_mask(segment_ids)
+            # a token is no target of the last token of the previous document, nor of the padding
+            same_document = (segment_ids[:, 1:] == segment_ids[:, :-1]) & (segment_ids[:, 1:] != 0)
+            same_document = F.pad(same_document, (1, 0))
+            mask = same_document if mask is None else (mask != 0) & same_document
+        if pos is None:
+            pos = torch.arange(past, past + t, dtype=torch.long, device=device).unsqueeze(0) # shape (1, t)
 
         # forward the GPT model itself
         tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
-        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (1, t, n_embd)
+        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (1 or b, t, n_embd)
         x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
+        for i, block in enumerate(self.transformer.h):
+            x = block(x, kv_cache=kv_cache[i] if kv_cache is not None else None, attn_mask=attn_mask)
         x = self.transformer.ln_f(x)
-        logits = self.lm_head(x)
+
+        if targets is not None:
+            # masked tokens become IGNORE_INDEX targets, which all the losses skip (with a loss of 0)
+            if mask is not None:
+                targets = targets.masked_fill(mask == 0, IGNORE_INDEX)
+            if last_only:
+                x, targets = x[:, -2:-1, :], targets[:, -1:]
+            else:
+                # position i predicts token i + 1, the last position has nothing to predict. padding the
+                # targets instead of slicing the logits keeps the logits (and the hidden states) uncopied
+                targets = F.pad(targets[:, 1:], (0, 1), value=IGNORE_INDEX)
+        elif last_only:
+            x = x[:, -1:, :]
 
         # if we are given some desired targets also calculate the loss
         loss = None
+        if targets is None:
+            logits = self.lm_head(x)
+        elif self.loss_impl == 'full' or last_only:
+            logits = self.lm_head(x)
+            loss = F.cross_entropy(logits.flatten(0, 1), targets.flatten(), ignore_index=IGNORE_INDEX, reduction='none')
+        else:
+            # straight from the hidden states, without ever holding the logits of all positions
+            logits = None
+            hidden = x.flatten(0, 1)
+            if self.loss_impl == 'sampled' and self.training:
+                loss = sampled_softmax_loss(hidden, self.lm_head.weight, targets.flatten(), self.sampled_softmax_k,
+                                            ignore_index=IGNORE_INDEX)
+            else:
+                loss = chunked_cross_entropy(hidden, self.lm_head.weight, targets.flatten(),
+                                             chunk_size=self.loss_chunk_size, ignore_index=IGNORE_INDEX)
         if targets is not None:
-            # loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
-            logits = logits[:, :-1, :].contiguous().view(-1, logits.size(-1))
-            targets = targets[:, 1:].contiguous().view(-1)
-            loss = F.cross_entropy(logits, targets, reduction='none')
-            if mask is not None:
-                loss = loss.view(b, -1)
-                mask = mask[:, 1:].contiguous()
-                assert 0 not in mask.sum(dim=1), "each sequence must have at least one token unmasked"
-                loss = loss * mask
-            loss /= mask.sum(dim=1, keepdim=True)
-            loss = loss.sum() / b
+            loss = loss.view(b, -1)
+            predicted = targets != IGNORE_INDEX
+            if reduction == 'sum':
+                loss = loss.sum()
+            elif segment_ids is not None and not last_only:
+                # the loss and target count of every document, indexed by row * (t + 1) + segment id
+                # (the last position predicts nothing, its loss and count of 0 go to segment 0)
+                documents = F.pad(segment_ids[:, 1:], (0, 1)) + (t + 1) * torch.arange(b, device=device).unsqueeze(1)
+                document_loss = loss.new_zeros(b * (t + 1)).index_add_(0, documents.flatten(), loss.flatten())
+                document_tokens = loss.new_zeros(b * (t + 1)).index_add_(0, documents.flatten(), predicted.flatten().to(loss.dtype))
+                loss = (document_loss / document_tokens.clamp(min=1)).sum() / (document_tokens > 0).sum()
+            else:
+                # sequences without a single token to predict are left out of the mean. all on the
+                # device, checking for them on the host would wait for the forward pass to finish
+                tokens = predicted.sum(dim=1)
+                loss = (loss.sum(dim=1) / tokens.clamp(min=1)).sum() / (tokens > 0).sum().clamp(min=1)
 
         return logits, loss
 
+    def _next_logits(self, idx, kv_cache=None, use_cache=True):
+        """
+        the logits (b, vocab_size) of the token following idx (b, t), and the kv cache to pass in
+        the next step (start with None). With use_cache only the newest token goes through the model.
+        """
+        if not use_cache:
+            # if the sequence context is growing too long we must crop it at block_size
+            idx_cond = idx if idx.size(1) <= self.block_size else idx[:, -self.block_size:]
+            # forward the model to get the logits for the index in the sequence
+            logits, _ = self(idx_cond, last_only=True)
+        elif kv_cache is None or len(kv_cache[0]) + 1 > self.block_size:
+            # (re)fill the cache from the last block_size tokens. once the sequence is longer
+            # than block_size every step slides the window, and the absolute position embeddings
+            # of all cached positions shift, so we fall back to recomputing the cropped context
+            kv_cache = self.new_kv_cache()
+            logits, _ = self(idx[:, -self.block_size:], kv_cache=kv_cache, last_only=True)
+        else:
+            # only the newest token goes through the model, it attends to the cached ones
+            if self._decode_backend is not None:
+                logits, _ = _compiled_forward(self._decode_backend)(self, idx[:, -1:], kv_cache=kv_cache)
+            else:
+                logits, _ = self(idx[:, -1:], kv_cache=kv_cache)
+        # pluck the logits at the final step
+        return logits[:, -1, :], kv_cache
+
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, do_sample=False, top_k=None):
+    def generate(self, idx, max_new_tokens, temperature=1.0, do_sample=False, top_k=None, use_cache=True,
+                 draft_model=None, speculative_k=4, top_p=None, min_p=None, repetition_penalty=None,
+                 stop_token=None, num_beams=1, length_penalty=1.0):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        With use_cache the keys/values of past positions are kept around, so every step only
+        runs the newest token through the model instead of the whole context.
+        top_k, top_p, min_p and repetition_penalty shape the next token distribution, see gpt/decoding.py.
+        A sequence that generates stop_token is finished: it leaves the batch, so it costs no more
+        compute, and comes back padded with stop_token to the length of the others.
+        With a draft_model (a smaller GPT over the same vocabulary) decoding is speculative, see
+        generate_speculative, which takes all of the options above (and always uses the cache).
+        With num_beams > 1 it is a beam search, see generate_beam. That is deterministic, so it only
+        takes repetition_penalty, stop_token and length_penalty: do_sample, temperature, top_k, top_p
+        and min_p are rejected.
         """
+        if draft_model is not None:
+            assert num_beams == 1, "speculative decoding is not a beam search"
+            return self.generate_speculative(idx, max_new_tokens, draft_model, speculative_k, temperature, do_sample, top_k,
+                                             top_p, min_p, repetition_penalty, stop_token)
+        if num_beams > 1:
+            assert not do_sample and temperature == 1.0 and top_k is None and top_p is None and min_p is None, \
+                "beam search is deterministic, do_sample, temperature, top_k, top_p and min_p don't apply to it"
+            return self.generate_beam(idx, max_new_tokens, num_beams, length_penalty, stop_token, use_cache,
+                                      repetition_penalty)
+        b, t = idx.size()
+        out = idx.new_full((b, t + max_new_tokens), stop_token if stop_token is not None else 0)
+        rows = torch.arange(b, device=idx.device) # the row of out of every sequence still in the batch
+        kv_cache = None
         for _ in range(max_new_tokens):
-            # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = idx if idx.size(1) <= self.block_size else idx[:, -self.block_size:]
-            # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
-            # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / temperature
-            # optionally crop the logits to only the top k options
-            if top_k is not None:
-                v, _ = torch.topk(logits, top_k)
-                logits[logits < v[:, [-1]]] = -float('Inf')
-            # apply softmax to convert logits to (normalized) probabilities
-            probs = F.softmax(logits, dim=-1)
+            logits, kv_cache = self._next_logits(idx, kv_cache, use_cache)
+            if repetition_penalty is not None:
+                logits = apply_repetition_penalty(logits, idx, repetition_penalty)
             # either sample from the distribution or take the most likely element
-            if do_sample:
-                idx_next = torch.multinomial(probs, num_samples=1)
-            else:
-                _, idx_next = torch.topk(probs, k=1, dim=-1)
+            idx_next = sample_next_token(logits, temperature, top_k, top_p, min_p, do_sample)
             # append sampled index to the running sequence and continue
             idx = torch.cat((idx, idx_next), dim=1)
+            if stop_token is not None:
+                stopped = idx_next[:, 0] == stop_token
+                if stopped.any():
+                    # write the finished sequences out and drop them from the batch and the cache
+                    out[rows[stopped], :idx.size(1)] = idx[stopped]
+                    keep = (~stopped).nonzero().squeeze(1)
+                    idx, rows = idx[keep], rows[keep]
+                    for c in kv_cache or []:
+                        c.reorder(keep)
+                    if rows.numel() == 0:
+                        break
+        out[rows, :idx.size(1)] = idx
+
+        return out
+
+    @torch.no_grad()
+    def generate_beam(self, idx, max_new_tokens, num_beams=4, length_penalty=1.0, stop_token=None, use_cache=True,
+                      repetition_penalty=None):
+        """
+        Beam search for every sequence of idx (b, t): keep the num_beams most likely continuations,
+        extend each by every token, and keep the num_beams best of the extensions. The beams are
+        ranked by their log probability divided by (number of generated tokens) ** length_penalty,
+        so length_penalty > 0 favors longer and < 0 shorter sequences. A beam that generates
+        stop_token is finished, it stays in the running at its final score and is only extended by
+        more stop_tokens (which pad it). Once all the beams of a sequence are finished it leaves the
+        batch. repetition_penalty penalizes the tokens of every beam's own sequence, as in generate.
+        Returns the best beam of every sequence, (b, t + max_new_tokens).
+        """
+        b, t = idx.size()
+        vocab_size = self.lm_head.out_features
+        device = idx.device
+        out = idx.new_full((b, t + max_new_tokens), stop_token if stop_token is not None else 0)
+        rows = torch.arange(b, device=device) # the row of out of every sequence still in the batch
+        # all the beams of a sequence start out the same, so only the first one is extended at the start
+        idx = idx.repeat_interleave(num_beams, dim=0) # (b * num_beams, t)
+        scores = torch.zeros(b, num_beams, device=device)
+        scores[:, 1:] = -float('Inf')
+        lengths = torch.zeros(b, num_beams, dtype=torch.long, device=device)
+        finished = torch.zeros(b, num_beams, dtype=torch.bool, device=device)
+        if stop_token is not None:
+            # the only continuation of a finished beam: another stop_token, at no cost
+            stop_logprobs = torch.full((vocab_size,), -float('Inf'), device=device)
+            stop_logprobs[stop_token] = 0.0
+
+        def best(scores, lengths):
+            return (scores / lengths.clamp(min=1).float() ** length_penalty).argmax(dim=1)
+
+        kv_cache = None
+        for _ in range(max_new_tokens):
+            B = rows.numel()
+            logits, kv_cache = self._next_logits(idx, kv_cache, use_cache)
+            if repetition_penalty is not None:
+                logits = apply_repetition_penalty(logits, idx, repetition_penalty)
+            logprobs = F.log_softmax(logits.float(), dim=-1).view(B, num_beams, vocab_size)
+            if stop_token is not None:
+                logprobs = torch.where(finished.unsqueeze(-1), stop_logprobs, logprobs)
+            # score every extension of every beam, and rank them length normalized
+            candidates = scores.unsqueeze(-1) + logprobs # (B, num_beams, vocab_size)
+            candidate_lengths = torch.where(finished, lengths, lengths + 1)
+            ranked = candidates / candidate_lengths.unsqueeze(-1).float() ** length_penalty
+            _, top = ranked.view(B, -1).topk(num_beams, dim=-1)
+            beam, token = top // vocab_size, top % vocab_size
+            scores = candidates.view(B, -1).gather(1, top)
+            lengths = candidate_lengths.gather(1, beam)
+            finished = finished.gather(1, beam)
+            if stop_token is not None:
+                finished |= token == stop_token
+            # every beam continues the one it extends, so the sequences and caches follow their parents
+            parents = (beam + num_beams * torch.arange(B, device=device).unsqueeze(1)).view(-1)
+            idx = torch.cat((idx[parents], token.view(-1, 1)), dim=1)
+            for c in kv_cache or []:
+                c.reorder(parents)
+
+            if stop_token is not None:
+                done = finished.all(dim=1)
+                if done.any():
+                    # write the best beam of the finished sequences out and drop them from the batch and the cache
+                    beams = idx.view(B, num_beams, -1)
+                    out[rows[done], :idx.size(1)] = beams[done, best(scores[done], lengths[done])]
+                    keep = (~done).nonzero().squeeze(1)
+                    keep_beams = (keep.unsqueeze(1) * num_beams + torch.arange(num_beams, device=device)).view(-1)
+                    idx, rows = idx[keep_beams], rows[keep]
+                    scores, lengths, finished = scores[keep], lengths[keep], finished[keep]
+                    for c in kv_cache or []:
+                        c.reorder(keep_beams)
+                    if rows.numel() == 0:
+                        break
+        beams = idx.view(rows.numel(), num_beams, -1)
+        out[rows, :idx.size(1)] = beams[torch.arange(rows.numel(), device=device), best(scores, lengths)]
+
+        return out
 
+    @torch.no_grad()
+    def generate_speculative(self, idx, max_new_tokens, draft_model, k=4, temperature=1.0, do_sample=False, top_k=None,
+                             top_p=None, min_p=None, repetition_penalty=None, stop_token=None):
+        """
+        Speculative decoding (Leviathan et al. 2023, https://arxiv.org/abs/2211.17192) of a single
+        sequence idx (1, t): every round the draft model proposes k tokens one at a time, and this
+        model scores all of them in a single forward pass. Proposal i is accepted with probability
+        min(1, p_i / q_i) (p of this model, q of the draft); at the first rejection a token is drawn
+        from the normalized max(0, p - q) instead and the round ends, and if all k are accepted a
+        bonus token is drawn from p. The output follows exactly the distribution of sampling from
+        this model alone (and for greedy decoding, its greedy tokens). The counts of proposed and
+        accepted tokens of the call are left in self.speculative_stats.
+        top_k, top_p, min_p and repetition_penalty shape both distributions (p and q) the way they
+        shape sampling in generate, so the output follows sampling from this model with them. Once
+        stop_token is accepted the sequence is finished and padded with stop_token, as in generate.
+        Past the context window of either model every step slides the window (see generate), and
+        the proposals can't be verified in one pass anymore, the rest is then decoded without the draft.
+        """
+        assert idx.size(0) == 1, "speculative decoding works on a single sequence"
+        block_size = min(self.block_size, draft_model.block_size)
+        n_new = idx.size(1) + max_new_tokens
+        stats = dict(rounds=0, proposed=0, accepted=0)
+        # every forward pass feeds the tokens past the ones in the cache, so both models catch up
+        # on whatever they haven't seen yet
+        cache, draft_cache = self.new_kv_cache(), draft_model.new_kv_cache()
+        while idx.size(1) < n_new:
+            n = idx.size(1)
+            # this model has to see n + k_round tokens in the verifying pass
+            k_round = min(k, n_new - n - 1, block_size - n)
+            if k_round < 0:
+                idx = self.generate(idx, n_new - n, temperature, do_sample, top_k, top_p=top_p, min_p=min_p,
+                                    repetition_penalty=repetition_penalty, stop_token=stop_token)
+                break
+
+            # the draft proposes k_round tokens
+            draft, draft_probs = idx, []
+            for _ in range(k_round):
+                logits, _ = draft_model(draft[:, len(draft_cache[0]):], kv_cache=draft_cache)
+                logits = logits[:, -1, :]
+                if repetition_penalty is not None:
+                    logits = apply_repetition_penalty(logits, draft, repetition_penalty)
+                q = logits_to_probs(logits, temperature, top_k, top_p, min_p)
+                x = torch.multinomial(q, num_samples=1) if do_sample else torch.argmax(q, dim=-1, keepdim=True)
+                draft_probs.append(q[0])
+                draft = torch.cat((draft, x), dim=1)
+            proposed = draft[0, n:]
+
+            # this model scores the proposals (and the position after them) in one pass
+            logits, _ = self(draft[:, len(cache[0]):], kv_cache=cache)
+            logits = logits[0, -(k_round + 1):, :]
+            if repetition_penalty is not None:
+                # the distribution of position n + i is penalized by the tokens before it
+                logits = torch.cat([apply_repetition_penalty(logits[i:i+1], draft[:, :n + i], repetition_penalty)
+                                    for i in range(k_round + 1)])
+            probs = logits_to_probs(logits, temperature, top_k, top_p, min_p)
+
+            accepted = 0
+            next_token = None
+            for i in range(k_round):
+                p, q, x = probs[i], draft_probs[i], proposed[i]
+                if do_sample:
+                    if torch.rand(()).item() < min(1.0, (p[x] / q[x]).item()):
+                        accepted += 1
+                        continue
+                    residual = (p - q).clamp(min=0)
+                    residual = residual if residual.sum() > 0 else p
+                    next_token = torch.multinomial(residual / residual.sum(), num_samples=1)
+                else:
+                    if x == torch.argmax(p):
+                        accepted += 1
+                        continue
+                    next_token = torch.argmax(p).view(1)
+                break
+            if next_token is None:
+                # everything was accepted, the pass already gave the distribution after the last one
+                p = probs[k_round]
+                next_token = torch.multinomial(p, num_samples=1) if do_sample else torch.argmax(p).view(1)
+
+            idx = torch.cat((idx, proposed[:accepted].view(1, -1), next_token.view(1, 1)), dim=1)
+            # forget the rejected positions, the caches end right before the token we just picked
+            for c in cache + draft_cache:
+                c.crop(n + accepted)
+            stats['rounds'] += 1
+            stats['proposed'] += k_round
+            stats['accepted'] += accepted
+            if stop_token is not None:
+                stopped = (idx[0, n:] == stop_token).nonzero()
+                if stopped.numel() > 0:
+                    # cut the sequence after its first stop_token, and pad it like generate does
+                    idx = idx[:, :n + stopped[0, 0].item() + 1]
+                    idx = torch.cat((idx, idx.new_full((1, n_new - idx.size(1)), stop_token)), dim=1)
+                    break
+
+        self.speculative_stats = stats
         return idx
@@ -0,0 +1,76 @@
+"""
+Background prefetching of training batches, so that fetching, collating and copying the
+next batches to the device overlaps with the training step on the current one.
+"""
+
+import queue
+import threading
+
+import torch
+
+# -----------------------------------------------------------------------------
+
+class Prefetcher:
+    """
+    Pulls (batch, info) pairs from `produce` on a background thread and keeps up to `depth` of them
+    ready. Every batch is a list of tensors; on cuda they are pinned and copied to the device on a
+    side stream, so the host-to-device copy of the next batch runs during the current step.
+    `info` is passed through untouched, e.g. the data position a batch came from.
+    """
+
+    def __init__(self, produce, device, depth=2):
+        self.produce = produce
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if str(device).startswith('cuda') else None
+        self.queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        try:
+            while not self._stop.is_set():
+                batch, info = self.produce()
+                event = None
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        batch = [(t if t.is_pinned() else t.pin_memory()).to(self.device, non_blocking=True)
+                                 for t in batch]
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                self._put((batch, info, event))
+        except Exception as e:
+            # hand the error to the consumer, it is raised from get()
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get(self):
+        """ the next (batch, info), with the batch on the device """
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        batch, info, event = item
+        if event is not None:
+            # make the compute stream wait for the copy, and keep the allocator from reusing the
+            # memory of these tensors before the compute stream is done with them
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            for t in batch:
+                t.record_stream(stream)
+        else:
+            batch = [t.to(self.device) for t in batch]
+        return batch, info
+
+    def close(self):
+        self._stop.set()
+        # unblock a worker that is waiting for room in the queue
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self._thread.join()
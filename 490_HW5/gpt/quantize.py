@@ -0,0 +1,92 @@
+"""
+Int8 variants of a trained GPT for inference on CPU. Every nn.Linear (the attention and MLP
+projections and the lm_head) gets int8 weights with one scale per output channel, either
+
+- quantize_dynamic: torch's dynamically quantized Linear, which also quantizes the activations
+  on the fly (per batch) and runs the matmuls in int8 (fbgemm/onednn kernels), or
+- quantize_weight_only: Int8Linear, which only stores the weights in int8 and dequantizes them
+  a block of output channels at a time in the matmul, so activations and accumulation stay in
+  floating point and the weights never exist in floating point all at once.
+
+Both return a quantized copy and leave the model itself untouched. The copies are inference only,
+and compute the loss from the full logits (loss_impl='full').
+"""
+
+import io
+import copy
+
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+# -----------------------------------------------------------------------------
+
+def quantize_dynamic(model):
+    """ a copy of model with every nn.Linear dynamically quantized to int8, per output channel """
+    from torch.ao.quantization import quantize_dynamic as _quantize_dynamic, per_channel_dynamic_qconfig
+    model = _quantize_dynamic(model, {nn.Linear: per_channel_dynamic_qconfig}, dtype=torch.qint8, inplace=False)
+    model.loss_impl = 'full'
+    return model.eval()
+
+class Int8Linear(nn.Module):
+    """
+    a Linear with int8 weights and one floating point scale per output channel. Every forward
+    dequantizes the weights again, chunk_elements at a time: that keeps them int8 in memory (a
+    cached floating point copy would undo the saving), and a chunk that small is still in cache
+    when the matmul reads it. The cost is a dequantization per step, which makes it slower than a
+    floating point weight, but much faster than dequantizing the whole weight at once.
+    """
+
+    # weights dequantized per chunk of output channels, ~8MB in fp32
+    chunk_elements = 2**21
+
+    def __init__(self, in_features, out_features, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer('weight_int8', torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer('scale', torch.ones(out_features))
+        self.register_buffer('bias', torch.zeros(out_features) if bias else None)
+
+    @classmethod
+    def from_float(cls, linear):
+        """ symmetric per output channel quantization of the weights of linear """
+        weight = linear.weight.detach().float()
+        layer = cls(linear.in_features, linear.out_features, bias=linear.bias is not None)
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        layer.weight_int8.copy_(torch.round(weight / scale.unsqueeze(1)).clamp(-127, 127).to(torch.int8))
+        layer.scale.copy_(scale)
+        if linear.bias is not None:
+            layer.bias.copy_(linear.bias.detach())
+        return layer
+
+    def forward(self, x):
+        y = x.new_empty(*x.shape[:-1], self.out_features)
+        rows = max(1, self.chunk_elements // self.in_features)
+        scale = self.scale.to(x.dtype)
+        for start in range(0, self.out_features, rows):
+            end = min(start + rows, self.out_features)
+            # x @ (q * s).T == (x @ q.T) * s, so the scales apply to the outputs of the int8 matrix
+            y[..., start:end] = F.linear(x, self.weight_int8[start:end].to(x.dtype)) * scale[start:end]
+        if self.bias is not None:
+            y += self.bias.to(x.dtype)
+        return y
+
+    def extra_repr(self):
+        return f'in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}'
+
+def quantize_weight_only(model):
+    """ a copy of model with every nn.Linear replaced by an Int8Linear """
+    model = copy.deepcopy(model)
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, nn.Linear):
+                setattr(module, name, Int8Linear.from_float(child))
+    model.loss_impl = 'full'
+    return model.eval()
+
+def model_size_mb(model):
+    """ size of the serialized state_dict of model, which includes the packed weights of quantized modules """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2**20
@@ -0,0 +1,219 @@
+"""
+A small local inference server around GPT that does continuous batching.
+
+Prompts arrive on an asyncio queue and are admitted into the running batch as soon as
+there is room for them. Every model step then advances all active sequences by one token,
+and each sequence retires on its own as soon as it is done, so short requests never wait
+for long ones. The generated tokens are streamed back to every caller as they are made.
+
+Sequences in the batch have different lengths. Their keys/values are kept right-aligned
+in one shared kv cache (shorter rows are padded on the left), every row gets its own
+position ids, and an attention mask hides the padding from the new tokens.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from gpt.decoding import sample_next_token
+
+# -----------------------------------------------------------------------------
+
+class Request:
+    """ one prompt being served, plus the queue its generated tokens are streamed through """
+
+    def __init__(self, prompt_ids, max_new_tokens, temperature, do_sample, top_k, stop_token):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.do_sample = do_sample
+        self.top_k = top_k
+        self.stop_token = stop_token
+        # generated token ids, a None marks the end of the stream and an exception that it failed
+        self.tokens = asyncio.Queue()
+        self.num_generated = 0
+        # the last generated token, which still has to be fed through the model
+        self.next_token = None
+        # number of positions of this sequence held in the kv cache
+        self.length = 0
+
+class InferenceServer:
+    """
+    Serves concurrent generation requests from a single GPT. Use it as an async context manager:
+
+        async with InferenceServer(model, tokenizer) as server:
+            async for token in server.stream(' The best way to learn', max_new_tokens=30):
+                ...
+    """
+
+    def __init__(self, model, tokenizer=None, max_batch_size=8, device='cpu'):
+        self.model = model.to(device)
+        self.model.eval()
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.device = device
+        self.queue = None
+        # the running batch: row i of the kv cache belongs to self.active[i]
+        self.active = []
+        self.kv_cache = None
+        # model steps run on a worker thread so the event loop keeps accepting and streaming
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._task = None
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except (asyncio.CancelledError, Exception):
+            # whatever the loop died of was already passed on to the streams it concerned
+            pass
+        # close the streams of everything that was still in flight
+        for req in self.active:
+            req.tokens.put_nowait(None)
+        while not self.queue.empty():
+            self.queue.get_nowait().tokens.put_nowait(None)
+        self.active, self.kv_cache = [], None
+        self._executor.shutdown()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def submit(self, prompt, max_new_tokens=20, temperature=1.0, do_sample=False, top_k=None, stop_token=None):
+        """ queue a prompt (a string, or a list of token ids) and return its Request """
+        prompt_ids = self.tokenizer.encoder.encode(prompt) if isinstance(prompt, str) else list(prompt)
+        assert len(prompt_ids) > 0, "the prompt must hold at least one token"
+        # leave room in the context for at least one generated token
+        prompt_ids = prompt_ids[-(self.model.block_size - 1):]
+        req = Request(prompt_ids, max_new_tokens, temperature, do_sample, top_k, stop_token)
+        await self.queue.put(req)
+        return req
+
+    async def stream(self, prompt, **kwargs):
+        """ submit a prompt and yield its generated token ids as they are produced, a failed model step is raised """
+        req = await self.submit(prompt, **kwargs)
+        while True:
+            token = await req.tokens.get()
+            if token is None:
+                return
+            if isinstance(token, Exception):
+                raise token
+            yield token
+
+    async def generate(self, prompt, **kwargs):
+        """ submit a prompt and wait for all of its generated token ids """
+        return [token async for token in self.stream(prompt, **kwargs)]
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            new = []
+            if not self.active:
+                # nothing running, sleep until a request shows up
+                new.append(await self.queue.get())
+            # admit as many waiting requests as fit in the batch
+            while len(self.active) + len(new) < self.max_batch_size and not self.queue.empty():
+                new.append(self.queue.get_nowait())
+            try:
+                emitted = await loop.run_in_executor(self._executor, self._step, new)
+            except Exception as e:
+                # the batch is in an unknown state after a failed step: fail every request in it, the
+                # newly admitted ones included, and go on serving the next ones from an empty batch
+                for req in self.active + [req for req in new if req not in self.active]:
+                    req.tokens.put_nowait(e)
+                self.active, self.kv_cache = [], None
+                continue
+            for req, token, done in emitted:
+                req.tokens.put_nowait(token)
+                if done:
+                    req.tokens.put_nowait(None)
+
+    def _step(self, new):
+        """ admit the new requests, then advance every active sequence by one token """
+        emitted = []
+        with torch.no_grad():
+            if new:
+                self._admit(new, emitted)
+            if self.active:
+                self._decode(emitted)
+        return emitted
+
+    def _row(self, i):
+        """ per-layer (k, v) of shape (1, nh, length, hs) of active row i, without its left padding """
+        L, length = len(self.kv_cache[0]), self.active[i].length
+        return [(c.k[i:i+1, :, L - length:L], c.v[i:i+1, :, L - length:L]) for c in self.kv_cache]
+
+    def _admit(self, new, emitted):
+        rows = [(req, self._row(i)) for i, req in enumerate(self.active)]
+        for req in new:
+            # prefill the prompt on its own, this also yields the first generated token
+            kv_cache = self.model.new_kv_cache()
+            idx = torch.tensor([req.prompt_ids], dtype=torch.long, device=self.device)
+            logits, _ = self.model(idx, kv_cache=kv_cache, last_only=True)
+            req.length = len(req.prompt_ids)
+            if self._emit(req, logits[0, -1], emitted):
+                rows.append((req, [(c.k[:, :, :c.length], c.v[:, :, :c.length]) for c in kv_cache]))
+        self._repack(rows)
+
+    def _decode(self, emitted):
+        B, L = len(self.active), len(self.kv_cache[0])
+        idx = torch.tensor([[req.next_token] for req in self.active], dtype=torch.long, device=self.device)
+        lengths = torch.tensor([req.length for req in self.active], dtype=torch.long, device=self.device)
+        # the new token of each row sits at position `length` and may attend to the last
+        # `length` cached columns of its row (everything before them is left padding) and itself
+        pos = lengths.view(B, 1)
+        attn_mask = torch.arange(L + 1, device=self.device).view(1, -1) >= (L - lengths).view(-1, 1)
+        logits, _ = self.model(idx, kv_cache=self.kv_cache, pos=pos, attn_mask=attn_mask.view(B, 1, 1, L + 1))
+
+        keep = []
+        for i, req in enumerate(self.active):
+            req.length += 1
+            if self._emit(req, logits[i, -1], emitted):
+                keep.append(i)
+        if len(keep) < B:
+            # retire finished sequences, and drop the padding columns nobody needs anymore
+            self._repack([(self.active[i], self._row(i)) for i in keep])
+
+    def _emit(self, req, logits, emitted):
+        """ sample the next token of req from its logits (vocab_size,), return whether it keeps going """
+        token = self._sample(logits, req)
+        req.num_generated += 1
+        req.next_token = token
+        done = (req.num_generated >= req.max_new_tokens or token == req.stop_token
+                or req.length >= self.model.block_size) # no room left to feed the token back in
+        emitted.append((req, token, done))
+        return not done
+
+    @staticmethod
+    def _sample(logits, req):
+        return sample_next_token(logits.unsqueeze(0), req.temperature, req.top_k, do_sample=req.do_sample).item()
+
+    def _repack(self, rows):
+        """
+        build the batch kv cache from rows of (request, per-layer (k, v) of shape (1, nh, length, hs)),
+        right-aligning every row so that all of them append their next token in the same column
+        """
+        self.active = [req for req, _ in rows]
+        if not rows:
+            self.kv_cache = None
+            return
+        B, L = len(rows), max(req.length for req in self.active)
+        kv_cache = self.model.new_kv_cache()
+        for layer, cache in enumerate(kv_cache):
+            k0, v0 = rows[0][1][layer]
+            cache.k = k0.new_zeros(B, k0.size(1), cache.max_len, k0.size(3))
+            cache.v = v0.new_zeros(B, v0.size(1), cache.max_len, v0.size(3))
+            for i, (req, kv) in enumerate(rows):
+                k, v = kv[layer]
+                cache.k[i, :, L - req.length:L] = k[0]
+                cache.v[i, :, L - req.length:L] = v[0]
+            cache.length = L
+        self.kv_cache = kv_cache
@@ -1,12 +1,113 @@
+import os
+import copy
+import glob
+import math
 import time
+import random
+import itertools
 from collections import defaultdict
+from contextlib import nullcontext
 
 import torch
 import numpy as np
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import RandomSampler, DistributedSampler, Subset
 from torch.utils.data.dataloader import DataLoader
 from gpt.utils import CfgNode as CN
+from gpt.utils import reset_peak_memory, current_memory_mb, peak_memory_mb
+from gpt.prefetch import Prefetcher
+from gpt.metrics import StepTimer, JSONLSink, ProfilerWindow, git_commit
 from matplotlib import pyplot as plt
 
+def autocast_context(precision, device_type):
+    """ context for forward passes, running them in the given precision """
+    if precision == 'fp32':
+        return nullcontext()
+    dtype = torch.bfloat16 if precision == 'bf16' else torch.float16
+    return torch.autocast(device_type=device_type, dtype=dtype)
+
+def evaluate_loader(model, loader, device, precision='fp32', max_batches=None):
+    """ the summed loss of model over all unmasked tokens of (the first max_batches batches of) loader, and their number """
+    device_type = 'cuda' if str(device).startswith('cuda') else 'cpu'
+    model.eval()
+    loss_sum = torch.zeros((), device=device)
+    tokens = torch.zeros((), device=device)
+    with torch.no_grad():
+        for batch in itertools.islice(loader, max_batches):
+            input_ids, labels, masks, *segment_ids = [t.to(device) for t in batch]
+            segment_ids = segment_ids[0] if segment_ids else None
+            with autocast_context(precision, device_type):
+                _, loss = model(input_ids, labels, masks, reduction='sum', segment_ids=segment_ids)
+            # accumulate on the device, so there is only a single sync at the end
+            loss_sum += loss.float()
+            tokens += masks[:, 1:].sum() if segment_ids is None else _document_targets(masks, segment_ids)
+    return loss_sum.item(), tokens.item()
+
+def evaluate_stream(model, tokens, device, stride=None, batch_size=8, precision='fp32', max_windows=None):
+    """
+    the summed loss of model over the token stream tokens (1d), and the number of tokens it predicted,
+    with strided sliding windows: a window of block_size tokens starts every stride tokens, and only
+    scores the tokens past the end of the window before it. With stride < block_size every token but
+    the first is predicted exactly once, from at least block_size - stride tokens of context (all the
+    tokens before it at the start of the stream), with stride == block_size the windows don't overlap
+    and their first tokens go unpredicted. A smaller stride gives more context, for about
+    block_size / stride times the compute.
+    """
+    device_type = 'cuda' if str(device).startswith('cuda') else 'cpu'
+    block_size = model.block_size
+    stride = stride or block_size
+    assert 0 < stride <= block_size
+    n = tokens.numel()
+    tokens = tokens.to(device)
+    # the last window is the first one that reaches the end of the stream
+    num_windows = max(0, math.ceil((n - block_size) / stride)) + 1
+    if max_windows is not None:
+        num_windows = min(num_windows, max_windows)
+    steps = torch.arange(block_size, device=device)
+    model.eval()
+    loss_sum = torch.zeros((), device=device)
+    predicted = torch.zeros((), device=device)
+    with torch.no_grad():
+        for first in range(0, num_windows, batch_size):
+            windows = torch.arange(first, min(first + batch_size, num_windows), device=device)
+            positions = windows.unsqueeze(1) * stride + steps # (b, block_size) positions in the stream
+            input_ids = tokens[positions.clamp(max=n - 1)]
+            # the first window scores all its tokens (but the very first), the others only their last stride,
+            # and the last one is cut off at the end of the stream
+            scored = torch.full_like(windows, block_size - stride).masked_fill(windows == 0, 1).unsqueeze(1)
+            masks = ((steps >= scored) & (positions < n)).float()
+            with autocast_context(precision, device_type):
+                _, loss = model(input_ids, input_ids, masks, reduction='sum')
+            loss_sum += loss.float()
+            predicted += masks[:, 1:].sum()
+    return loss_sum.item(), predicted.item()
+
+def _document_targets(masks, segment_ids):
+    """ the number of tokens of packed rows that are predicted from a token of their own document """
+    same_document = (segment_ids[:, 1:] == segment_ids[:, :-1]) & (segment_ids[:, 1:] != 0)
+    return (masks[:, 1:] * same_document).sum()
+
+def _numpy_rng_state():
+    """ the global numpy rng state, with its key array as a tensor (a numpy array can't be loaded weights_only) """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian
+
+def _set_numpy_rng_state(state):
+    name, keys, pos, has_gauss, cached_gaussian = state
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+
+def _eval_worker(model, dataset, batch_size, collate_fn, device, precision, max_batches, results, stream=None,
+                 stride=None):
+    """ entry point of the asynchronous evaluation process """
+    if stream is not None:
+        max_windows = max_batches * batch_size if max_batches is not None else None
+        results.put(evaluate_stream(model.to(device), stream, device, stride, batch_size, precision, max_windows))
+        return
+    loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn)
+    results.put(evaluate_loader(model.to(device), loader, device, precision, max_batches))
+
 class Trainer:
 
     @staticmethod
@@ -23,6 +124,54 @@ class Trainer:
         C.betas = (0.9, 0.95)
         C.weight_decay = 0.1 # only applied on matmul weights
         C.grad_norm_clip = 1.0
+        # numerical precision of the forward pass: 'fp32', 'bf16' (autocast, works on cpu too)
+        # or 'fp16-with-scaler' (autocast plus dynamic loss scaling, cuda only)
+        C.precision = 'fp32'
+        # split every batch into micro-batches of this many sequences and accumulate their gradients
+        # before the optimizer step: None runs the whole batch at once, 'auto' probes for the largest
+        # micro-batch whose training step fits in memory_budget_mb
+        C.micro_batch_size = None
+        C.memory_budget_mb = None
+        # seeds the order of the training batches in every epoch, so a resumed run sees the same ones
+        C.data_seed = 3407
+        # every checkpoint_interval iterations the full training state is written to checkpoint_dir,
+        # keeping the last keep_checkpoints of them, plus the one with the best validation ppl
+        C.checkpoint_dir = None
+        C.checkpoint_interval = 1000
+        C.keep_checkpoints = 3
+        # a checkpoint file to resume training from, or 'latest' for the newest one in checkpoint_dir
+        C.resume_from = None
+        # distributed data parallel training, launched with torchrun: every process trains on its own
+        # shard of the training data and the gradients are all-reduced (gloo also works across cpus)
+        C.distributed = False
+        C.dist_backend = 'gloo'
+        # a background thread keeps this many batches fetched, collated and copied to the device
+        # ahead of the training step, 0 (the default) fetches every batch on the critical path
+        C.prefetch_batches = 0
+        # append one JSON record per step (timings, throughput, memory) to this file, None disables it.
+        # it also synchronizes cuda around every phase of the step, so that the timings are exact
+        C.metrics_path = None
+        # peak FLOP/s of the device, to report the model FLOPs utilization against (e.g. 312e12 for bf16 on an A100)
+        C.peak_flops = None
+        # record the iterations [start, stop) with torch.profiler and export them as a Chrome trace to profile_dir
+        C.profile_iters = None
+        C.profile_dir = 'traces'
+        # validate every eval_interval iterations, on at most eval_max_batches batches of the dev set or on
+        # a random subset of eval_subset sequences of it (drawn once with data_seed, the same in every eval)
+        C.eval_interval = 1000
+        C.eval_max_batches = None
+        C.eval_subset = None
+        # validate a snapshot of the model in a separate process while training goes on, on eval_device
+        # (the training device by default). the results come in, and their callbacks fire, a few steps later
+        C.eval_async = False
+        C.eval_device = None
+        # validate on the dev set as one token stream instead of its independent chunks, in windows of
+        # block_size tokens that start every eval_stride tokens and overlap as context (see evaluate_stream)
+        C.eval_stride = None
+        # torch.compile the training forward/backward, 'inductor' generates C++/OpenMP kernels on cpu
+        # (and triton ones on gpu), 'aot_eager' only traces and is the cheap way to check the graphs
+        C.compile = False
+        C.compile_backend = 'inductor'
         return C
 
     def __init__(self, config, model, train_dataloader, dev_dataloader):
@@ -32,15 +181,50 @@ class Trainer:
         # self.train_dataset = train_dataset
         self.train_dataloader = train_dataloader
         self.dev_dataloader = dev_dataloader
+        # what evaluation actually runs on, the same sequences every time
+        self.eval_dataloader = self._eval_subset(dev_dataloader) if config.eval_subset is not None else dev_dataloader
+        assert config.eval_stride is None or config.eval_subset is None, "a subset of the chunks is no stream"
+        self.eval_stream = dev_dataloader.dataset.token_stream() if config.eval_stride is not None else None
         self.callbacks = defaultdict(list)
 
+        # join the process group, torchrun tells every process its rank and the world size
+        self.rank, self.world_size = 0, 1
+        if config.distributed:
+            if not dist.is_initialized():
+                dist.init_process_group(backend=config.dist_backend)
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+            self.train_dataloader = self._shard(train_dataloader)
+        # evaluation, checkpoints and callbacks only happen on the master process
+        self.is_master = self.rank == 0
+
         # determine the device we'll train on
         if config.device == 'auto':
             self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         else:
             self.device = config.device
+        if config.distributed and self.device == 'cuda':
+            # one gpu per process
+            self.device = f"cuda:{int(os.environ.get('LOCAL_RANK', 0))}"
+            torch.cuda.set_device(self.device)
         self.model = self.model.to(self.device)
-        print("running on device", self.device)
+        print("running on device", self.device, f"(rank {self.rank} of {self.world_size})" if config.distributed else "")
+        # the module the training steps go through, it all-reduces the gradients in backward
+        self.train_model = self.model
+        if config.distributed:
+            self.train_model = DistributedDataParallel(self.model, device_ids=[torch.device(self.device)] if self.device != 'cpu' else None)
+        if config.compile:
+            # a differently sized batch (e.g. the last micro-batch) recompiles once, with dynamic shapes
+            self.train_model = torch.compile(self.train_model, backend=config.compile_backend)
+
+        # mixed precision: autocast the forward pass, and scale the loss when running in fp16
+        assert config.precision in ('fp32', 'bf16', 'fp16-with-scaler')
+        self.device_type = 'cuda' if str(self.device).startswith('cuda') else 'cpu'
+        assert config.precision != 'fp16-with-scaler' or self.device_type == 'cuda', "fp16 training needs a cuda device"
+        # a disabled scaler passes the loss, the unscale and the optimizer step straight through
+        self.scaler = torch.amp.GradScaler('cuda', enabled=config.precision == 'fp16-with-scaler')
+        assert config.micro_batch_size != 'auto' or config.memory_budget_mb is not None, \
+            "micro_batch_size='auto' needs a memory_budget_mb"
+        self.micro_batch_size = config.micro_batch_size
 
         # variables that will be assigned to trainer class later for logging and etc
         self.iter_num = 0
@@ -48,6 +232,12 @@ class Trainer:
         self.iter_dt = 0.0
         self.iter_train_loss = 0.0
         self.iter_train_ppl = 0.0
+        self.iter_mem_delta = 0.0 # how far the memory peaked above its level at the start of the step, in MB
+        self.iter_data_wait = 0.0 # seconds the step waited for its batch
+        self.iter_data_wait_frac = 0.0 # and that as a fraction of the whole step
+        self.iter_tokens = 0 # tokens in the batch that aren't padding, a tensor on the device once training runs
+        self.iter_peak_mem = 0.0 # peak memory during the step, in MB
+        self.step_metrics = {} # everything above and the time spent in every phase of the step
         self.all_iter_train_loss = []
         self.all_iter_train_ppl = []
         self.valid_loss = 0.0
@@ -55,6 +245,15 @@ class Trainer:
         self.all_iter_valid_loss = []
         self.all_iter_valid_ppl = []
         self.best_valid_ppl = float('inf')
+        self.valid_iter = 0 # the iteration the last validation results are for
+        self.valid_model_state = None # and the state_dict of the model they were computed with
+        self.pending_eval = None # (iter_num, snapshot, process, results, candidate) of a running async evaluation
+        # position in the training data, and the best validation ppl we wrote a checkpoint for
+        self.epoch = 0
+        self.batch_in_epoch = 0
+        self.data_iter = None
+        self.prefetcher = None
+        self.best_checkpoint_ppl = float('inf')
 
     def add_callback(self, onevent: str, callback):
         self.callbacks[onevent].append(callback)
@@ -63,33 +262,272 @@ class Trainer:
         self.callbacks[onevent] = [callback]
 
     def trigger_callbacks(self, onevent: str):
+        if not self.is_master:
+            return
         for callback in self.callbacks.get(onevent, []):
             callback(self)
 
+    def autocast(self):
+        """ context for forward passes, running them in the configured precision """
+        return autocast_context(self.config.precision, self.device_type)
+
+    def find_micro_batch_size(self, max_batch_size, memory_budget_mb):
+        """
+        Probe training steps on full block_size sequences with micro-batches of 1, 2, 4, ... sequences
+        (up to max_batch_size) and return the largest one whose memory peak, plus room for the AdamW
+        moments, stays within memory_budget_mb.
+        """
+        model = self.model
+        vocab_size = model.lm_head.out_features
+        # the optimizer keeps two fp32 moments per parameter, which aren't allocated until its first step
+        optim_mb = 2 * 4 * sum(p.numel() for p in model.parameters()) / 2**20
+        baseline = current_memory_mb(self.device)
+        best, size = 1, 1
+        while size <= max_batch_size:
+            idx = torch.randint(vocab_size, (size, model.block_size), device=self.device)
+            mask = torch.ones(size, model.block_size, device=self.device)
+            reset_peak_memory(self.device)
+            try:
+                with self.autocast():
+                    _, loss = model(idx, idx, mask)
+                loss.backward()
+                used = peak_memory_mb(self.device) - baseline + optim_mb
+            except torch.OutOfMemoryError:
+                used = float('inf')
+            except RuntimeError as e:
+                # running out of cpu memory, and out of memory errors of other backends, are plain RuntimeErrors
+                if 'out of memory' not in str(e) and "can't allocate memory" not in str(e):
+                    raise
+                used = float('inf')
+            finally:
+                model.zero_grad(set_to_none=True)
+                loss = None
+            print(f"micro-batch size {size}: {used:.1f}MB")
+            if used > memory_budget_mb:
+                break
+            best, size = size, size * 2
+        return best
+
+    def _shard(self, loader):
+        """ rebuild loader so that this process only iterates over its 1/world_size share of the data """
+        if hasattr(loader.batch_sampler, 'set_epoch'):
+            # a batch sampler that shards its batches itself, like data.BucketBatchSampler
+            loader.batch_sampler.num_replicas, loader.batch_sampler.rank = self.world_size, self.rank
+            return loader
+        sampler = DistributedSampler(loader.dataset, num_replicas=self.world_size, rank=self.rank,
+                                     shuffle=isinstance(loader.sampler, RandomSampler), seed=self.config.data_seed)
+        return DataLoader(loader.dataset, batch_size=loader.batch_size, sampler=sampler, num_workers=loader.num_workers,
+                          collate_fn=loader.collate_fn, pin_memory=loader.pin_memory, drop_last=loader.drop_last)
+
+    def _eval_subset(self, loader):
+        """ a loader over a fixed random subset of eval_subset sequences of the dataset of loader """
+        generator = torch.Generator()
+        generator.manual_seed(self.config.data_seed)
+        indices = torch.randperm(len(loader.dataset), generator=generator)[:self.config.eval_subset].tolist()
+        return DataLoader(Subset(loader.dataset, indices), batch_size=loader.batch_size, collate_fn=loader.collate_fn,
+                          num_workers=loader.num_workers, pin_memory=loader.pin_memory)
+
+    def _epoch_iter(self, epoch):
+        """ an iterator over the training batches of epoch, shuffled by data_seed + epoch only """
+        loader = self.train_dataloader
+        generator = torch.Generator()
+        generator.manual_seed(self.config.data_seed + epoch)
+        # the loader draws its worker base seed from its generator, the sampler its permutation,
+        # so neither of them touches (or depends on) the global torch rng
+        loader.generator = generator
+        if isinstance(loader.sampler, RandomSampler):
+            loader.sampler.generator = generator
+        elif isinstance(loader.sampler, DistributedSampler):
+            loader.sampler.set_epoch(epoch)
+        elif hasattr(loader.batch_sampler, 'set_epoch'):
+            # a batch sampler that shuffles by its own seed + epoch, like data.BucketBatchSampler
+            loader.batch_sampler.seed = self.config.data_seed
+            loader.batch_sampler.set_epoch(epoch)
+        return iter(loader)
+
+    def _batches(self):
+        """
+        the training batches from the current data position on, moving on to the next epoch whenever
+        one runs out, each as (batch, (epoch, batch_in_epoch)) with the data position right after it
+        """
+        epoch, skip = self.epoch, self.batch_in_epoch
+        while True:
+            # replay the epoch up to the data position (only a resumed run starts mid epoch)
+            epoch_iter = itertools.islice(self._epoch_iter(epoch), skip, None)
+            batch_in_epoch = skip
+            for batch_in_epoch, batch in enumerate(epoch_iter, start=skip + 1):
+                yield batch, (epoch, batch_in_epoch)
+            if batch_in_epoch == 0:
+                # a whole epoch without a single batch, going on would spin forever
+                raise ValueError("the training dataloader yields no batches")
+            epoch, skip = epoch + 1, 0
+
+    def _next_batch(self):
+        """ the next training batch on the device, timing how long the step had to wait for it """
+        start = time.perf_counter()
+        if self.prefetcher is not None:
+            batch, (self.epoch, self.batch_in_epoch) = self.prefetcher.get()
+        else:
+            batch, (self.epoch, self.batch_in_epoch) = next(self.data_iter)
+            batch = [t.to(self.device) for t in batch]
+        self.iter_data_wait = time.perf_counter() - start
+        return batch
+
+    def save_checkpoint(self, path):
+        """ atomically write everything needed to continue training bit-exactly to path """
+        checkpoint = {
+            'model': self.model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scaler': self.scaler.state_dict(),
+            'iter_num': self.iter_num,
+            'epoch': self.epoch,
+            'batch_in_epoch': self.batch_in_epoch,
+            'micro_batch_size': self.micro_batch_size,
+            'best_valid_ppl': self.best_valid_ppl,
+            'best_checkpoint_ppl': self.best_checkpoint_ppl,
+            'history': {
+                'all_iter_train_loss': self.all_iter_train_loss,
+                'all_iter_train_ppl': self.all_iter_train_ppl,
+                'all_iter_valid_loss': self.all_iter_valid_loss,
+                'all_iter_valid_ppl': self.all_iter_valid_ppl,
+            },
+            'rng': {
+                'python': random.getstate(),
+                'numpy': _numpy_rng_state(),
+                'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            },
+        }
+        # write next to the target and rename over it, so a crash never leaves a truncated checkpoint
+        tmp_path = path + '.tmp'
+        torch.save(checkpoint, tmp_path)
+        os.replace(tmp_path, path)
+
+    def load_checkpoint(self, path):
+        """ restore a checkpoint written by save_checkpoint, except for the rng states which it returns """
+        # the checkpoint only holds tensors and python primitives, so it loads without unpickling any code
+        checkpoint = torch.load(path, map_location='cpu', weights_only=True)
+        self.model.load_state_dict(checkpoint['model'])
+        self.optimizer.load_state_dict(checkpoint['optimizer'])
+        self.scaler.load_state_dict(checkpoint['scaler'])
+        self.iter_num = checkpoint['iter_num']
+        self.epoch = checkpoint['epoch']
+        self.batch_in_epoch = checkpoint['batch_in_epoch']
+        self.micro_batch_size = checkpoint['micro_batch_size']
+        self.best_valid_ppl = checkpoint['best_valid_ppl']
+        self.best_checkpoint_ppl = checkpoint['best_checkpoint_ppl']
+        for k, v in checkpoint['history'].items():
+            setattr(self, k, v)
+        print(f"resumed from {path} at iter {self.iter_num}")
+        return checkpoint['rng']
+
+    def _checkpoint_paths(self):
+        return sorted(glob.glob(os.path.join(self.config.checkpoint_dir, 'ckpt_*.pt')))
+
+    def _save_periodic_checkpoint(self):
+        """ write a checkpoint for the current iteration and prune all but the last keep_checkpoints """
+        os.makedirs(self.config.checkpoint_dir, exist_ok=True)
+        self.save_checkpoint(os.path.join(self.config.checkpoint_dir, f'ckpt_{self.iter_num:08d}.pt'))
+        for path in self._checkpoint_paths()[:-self.config.keep_checkpoints]:
+            os.remove(path)
+
+    def _resume(self):
+        """ pick up training from config.resume_from, returns the rng states to restore (or None) """
+        path = self.config.resume_from
+        if path == 'latest':
+            paths = self._checkpoint_paths() if self.config.checkpoint_dir is not None else []
+            if not paths:
+                print("no checkpoint to resume from, starting from scratch")
+                return None
+            path = paths[-1]
+        # the data position is restored too, _batches picks up the epoch where the checkpoint left it
+        return self.load_checkpoint(path)
+
     def evaluation(self):
+        """ validate the model, or with eval_async start validating a snapshot of it in another process """
         model, config = self.model, self.config
-        model.eval()
-        valid_loss = []
-        valid_ppls = []
-        with torch.no_grad():
-            for batch in self.dev_dataloader:
-                batch = [t.to(self.device) for t in batch]
-                input_ids, labels, masks = batch
-                logits, loss = model(input_ids, labels, masks)
-                valid_loss.append(loss.item())
-                valid_ppls.append(torch.exp(loss).item())
-        self.valid_loss = sum(valid_loss) / len(valid_loss)
-        self.valid_ppl = sum(valid_ppls) / len(valid_ppls)
+        if config.eval_async:
+            self._start_async_evaluation()
+            return
+        # eval_device is for the async process, here the model is validated where it trains
+        device = self.device
+        if self.eval_stream is not None:
+            batch_size = self.eval_dataloader.batch_size
+            max_windows = config.eval_max_batches * batch_size if config.eval_max_batches is not None else None
+            loss_sum, tokens = evaluate_stream(model, self.eval_stream, device, config.eval_stride, batch_size,
+                                               config.precision, max_windows)
+        else:
+            loss_sum, tokens = evaluate_loader(model, self.eval_dataloader, device, config.precision,
+                                               config.eval_max_batches)
+        model.train()
+        self._finish_evaluation(self.iter_num, loss_sum, tokens, model.state_dict())
+
+    def _start_async_evaluation(self):
+        config, loader = self.config, self.eval_dataloader
+        # one evaluation at a time, wait for the previous one if it is still running
+        self._poll_evaluation(block=True)
+        snapshot = copy.deepcopy(self.model).cpu()
+        # training goes on while the snapshot is validated, so the training state it was taken from is
+        # written now, and becomes best.pt once (and if) the results come in as the best so far
+        candidate = None
+        if config.checkpoint_dir is not None:
+            os.makedirs(config.checkpoint_dir, exist_ok=True)
+            candidate = os.path.join(config.checkpoint_dir, f'eval_{self.iter_num:08d}.pt')
+            self.save_checkpoint(candidate)
+        ctx = mp.get_context('spawn') # forking a process that initialized cuda isn't safe
+        results = ctx.SimpleQueue()
+        process = ctx.Process(target=_eval_worker, daemon=True,
+                              args=(snapshot, loader.dataset, loader.batch_size, loader.collate_fn,
+                                    config.eval_device or self.device, config.precision, config.eval_max_batches, results,
+                                    self.eval_stream, config.eval_stride))
+        process.start()
+        self.pending_eval = (self.iter_num, snapshot, process, results, candidate)
+
+    def _poll_evaluation(self, block=False):
+        """ finish the running async evaluation if its results are in, or once they are with block """
+        if self.pending_eval is None:
+            return
+        iter_num, snapshot, process, results, candidate = self.pending_eval
+        while results.empty():
+            if not process.is_alive() and results.empty():
+                self.pending_eval = None
+                raise RuntimeError(f"evaluation process exited with code {process.exitcode}")
+            if not block:
+                return
+            process.join(timeout=0.1)
+        loss_sum, tokens = results.get()
+        process.join()
+        self.pending_eval = None
+        self._finish_evaluation(iter_num, loss_sum, tokens, snapshot.state_dict(), candidate)
+
+    def _finish_evaluation(self, iter_num, loss_sum, tokens, model_state, candidate=None):
+        """ record the validation results of the model at iter_num, candidate is the checkpoint of its training state """
+        config = self.config
+        # every token counts the same, no matter how full the batch it came in was
+        self.valid_iter = iter_num
+        self.valid_loss = loss_sum / tokens
+        self.valid_ppl = math.exp(self.valid_loss)
+        self.valid_model_state = model_state
         self.trigger_callbacks('on_validation_end')
         self.all_iter_valid_loss.append(self.valid_loss)
         self.all_iter_valid_ppl.append(self.valid_ppl)
-        model.train()
+        if config.checkpoint_dir is not None and self.valid_ppl < self.best_checkpoint_ppl:
+            self.best_checkpoint_ppl = self.valid_ppl
+            os.makedirs(config.checkpoint_dir, exist_ok=True)
+            best = os.path.join(config.checkpoint_dir, 'best.pt')
+            if candidate is not None:
+                os.replace(candidate, best)
+            else:
+                self.save_checkpoint(best)
+        elif candidate is not None:
+            os.remove(candidate)
 
     def plot(self):
         plt.clf()
+        interval = self.config.eval_interval
         plt.plot(list(range(0, len(self.all_iter_train_loss))), self.all_iter_train_loss, label='train loss')
-        plt.plot(list(range(0, len(self.all_iter_valid_loss) * 1000, 1000)), self.all_iter_valid_loss, label='valid loss')
-        plt.xticks(np.arange(0, len(self.all_iter_valid_loss) * 1000, 10000).astype(np.int32))
+        plt.plot(list(range(0, len(self.all_iter_valid_loss) * interval, interval)), self.all_iter_valid_loss, label='valid loss')
+        plt.xticks(np.arange(0, len(self.all_iter_valid_loss) * interval, 10 * interval).astype(np.int32))
         plt.xlabel('Steps')
         plt.ylabel(f'Loss')
         plt.legend()
@@ -97,8 +535,8 @@ class Trainer:
 
         plt.clf()
         plt.plot(list(range(0, len(self.all_iter_train_ppl))), self.all_iter_train_ppl, label='train ppl')
-        plt.plot(list(range(0, len(self.all_iter_valid_ppl) * 1000, 1000)), self.all_iter_valid_ppl, label='valid ppl')
-        plt.xticks(np.arange(0, len(self.all_iter_valid_ppl) * 1000, 10000).astype(np.int32))
+        plt.plot(list(range(0, len(self.all_iter_valid_ppl) * interval, interval)), self.all_iter_valid_ppl, label='valid ppl')
+        plt.xticks(np.arange(0, len(self.all_iter_valid_ppl) * interval, 10 * interval).astype(np.int32))
         plt.xlabel('Steps')
         plt.ylabel(f'Perplexity')
         if any(x <= 0 for x in self.all_iter_train_ppl + self.all_iter_valid_ppl):
@@ -114,46 +552,171 @@ class Trainer:
         # setup the optimizer
         self.optimizer = model.configure_optimizers(config)
 
-        model.train()
         self.iter_num = 0
+        rng = self._resume() if config.resume_from is not None else None
+
+        if self.micro_batch_size == 'auto':
+            max_batch_size = self.train_dataloader.batch_size or 2**12
+            self.micro_batch_size = self.find_micro_batch_size(max_batch_size, config.memory_budget_mb)
+            print(f"using micro-batches of {self.micro_batch_size} sequences")
+
+        model.train()
         self.iter_time = time.time()
-        data_iter = iter(self.train_dataloader)
-        # run evaluation before training
-        self.evaluation()
+        if rng is None:
+            # run evaluation before training
+            if self.is_master:
+                self.evaluation()
+        else:
+            # continue with exactly the random state the checkpoint was taken in
+            random.setstate(rng['python'])
+            _set_numpy_rng_state(rng['numpy'])
+            torch.set_rng_state(rng['torch'])
+            if rng['cuda'] and torch.cuda.is_available():
+                torch.cuda.set_rng_state_all(rng['cuda'])
+        # the batch order only depends on data_seed and the epoch, so fetching ahead on another
+        # thread hands out exactly the batches the synchronous loop would have
+        self.data_iter = self._batches()
+        if config.prefetch_batches > 0:
+            self.prefetcher = Prefetcher(lambda: next(self.data_iter), self.device, depth=config.prefetch_batches)
+        timer = StepTimer(sync=config.metrics_path is not None and self.device_type == 'cuda')
+        sink = JSONLSink(config.metrics_path) if config.metrics_path is not None and self.is_master else None
+        if sink is not None:
+            sink.write({'commit': git_commit(), 'time': time.time(), 'world_size': self.world_size,
+                        'config': config.to_dict()})
+        profiler = None
+        if config.profile_iters is not None:
+            profiler = ProfilerWindow(*config.profile_iters, config.profile_dir, self.device, name=f'trace_rank{self.rank}')
+        try:
+            self._train_loop(timer, sink, profiler)
+        finally:
+            if self.prefetcher is not None:
+                self.prefetcher.close()
+                self.prefetcher = None
+            if profiler is not None:
+                profiler.close()
+            if sink is not None:
+                sink.close()
+            if self.pending_eval is not None:
+                # only left over when training failed, its results don't matter anymore
+                _, _, process, _, candidate = self.pending_eval
+                process.terminate()
+                if candidate is not None and os.path.exists(candidate):
+                    os.remove(candidate)
+                self.pending_eval = None
+
+    def _step_metrics(self, timer, seq_len):
+        """
+        the metrics of the step that just finished. Those computed from the loss and the batch stay (0-d) tensors
+        on the device, reading them out would wait for the step to finish, so that only happens when they are written
+        """
+        metrics = {
+            'iter': self.iter_num,
+            'epoch': self.epoch,
+            'train_loss': self.iter_train_loss,
+            'dt': self.iter_dt,
+            'data_wait': self.iter_data_wait,
+            'data_wait_frac': self.iter_data_wait_frac,
+            **dict(timer.times),
+            'tokens': self.iter_tokens,
+            'tokens_per_sec': self.iter_tokens / self.iter_dt if self.iter_dt > 0 else 0.0,
+            'peak_mem_mb': self.iter_peak_mem,
+            'mem_delta_mb': self.iter_mem_delta,
+        }
+        if self.config.peak_flops is not None:
+            # utilization by the useful (non-padding) tokens, so time spent on padding counts against it
+            flops = self.model.flops_per_token(seq_len) * metrics['tokens_per_sec']
+            metrics['mfu'] = flops / self.config.peak_flops
+        return metrics
+
+    def _train_loop(self, timer, sink, profiler):
+        model, config = self.model, self.config
         start_time = time.time()
+        self.iter_time = start_time
         while True:
+            timer.reset()
+            if profiler is not None:
+                profiler.step_begin(self.iter_num)
 
-            # fetch the next batch (x, y) and re-init iterator if needed
-            try:
-                batch = next(data_iter)
-            except StopIteration:
-                data_iter = iter(self.train_dataloader)
-                batch = next(data_iter)
-            batch = [t.to(self.device) for t in batch]
-            input_ids, labels, masks = batch
+            # fetch the next batch (x, y), moving on to the next epoch if needed
+            batch = self._next_batch()
+            # rows packed with several documents come with their segment ids
+            input_ids, labels, masks, *segment_ids = batch
+            segment_ids = segment_ids[0] if segment_ids else None
+            self.iter_tokens = masks.sum().long()
+            reset_peak_memory(self.device)
+            mem_start = current_memory_mb(self.device)
 
-            # forward the model
-            # logits, self.loss = model(input_ids, labels)
-            logits, self.iter_train_loss = model(input_ids, labels, masks)
-            self.iter_train_ppl = torch.exp(self.iter_train_loss)
-            # backprop and update the parameters
+            # forward and backprop the batch, one micro-batch at a time, accumulating the gradients
             model.zero_grad(set_to_none=True)
-            self.iter_train_loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), config.grad_norm_clip)
-            self.optimizer.step()
+            B = input_ids.size(0)
+            micro = self.micro_batch_size or B
+            # the documents in every row (for packed rows, whose loss is a mean over the documents)
+            documents = segment_ids.amax(dim=1) if segment_ids is not None else None
+            train_loss = 0.0
+            for start in range(0, B, micro):
+                end = min(start + micro, B)
+                # with ddp, only the backward of the last micro-batch all-reduces the gradients
+                no_sync = self.train_model.no_sync() if config.distributed and end < B else nullcontext()
+                with no_sync:
+                    # logits, self.loss = model(input_ids, labels)
+                    with timer('forward'), self.autocast():
+                        logits, loss = self.train_model(input_ids[start:end], labels[start:end], masks[start:end],
+                                                        segment_ids=None if segment_ids is None else segment_ids[start:end])
+                        # the model averages over the sequences (documents) it is given, so weighting every micro-batch
+                        # by its share of the sequences (documents) adds up to exactly the loss of the whole batch
+                        if segment_ids is None:
+                            loss = loss * ((end - start) / B)
+                        else:
+                            loss = loss * (documents[start:end].sum() / documents.sum())
+                    with timer('backward'):
+                        self.scaler.scale(loss).backward()
+                train_loss = train_loss + loss.detach()
+            self.iter_train_loss = train_loss
+            self.iter_train_ppl = torch.exp(self.iter_train_loss)
+            # update the parameters
+            with timer('optimizer'):
+                # gradients have to be unscaled before their norm can be clipped
+                self.scaler.unscale_(self.optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), config.grad_norm_clip)
+                # skips the update if the fp16 gradients overflowed, and adapts the loss scale
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+            self.iter_peak_mem = peak_memory_mb(self.device)
+            self.iter_mem_delta = self.iter_peak_mem - mem_start
 
-            self.trigger_callbacks('on_batch_end')
-            self.iter_num += 1
             tnow = time.time()
             self.iter_dt = tnow - self.iter_time
             self.iter_time = tnow
+            self.iter_data_wait_frac = self.iter_data_wait / self.iter_dt if self.iter_dt > 0 else 0.0
+            self.step_metrics = self._step_metrics(timer, input_ids.size(1))
+            self.trigger_callbacks('on_batch_end')
+            if profiler is not None:
+                profiler.step_end(self.iter_num)
+            self.iter_num += 1
 
-            # evaluate the model
-            if self.iter_num % 1000 == 0:
-                self.evaluation()
+            # evaluate the model, and pick up the results of an asynchronous evaluation once they're in
+            if self.is_master:
+                self._poll_evaluation()
+            if self.iter_num % config.eval_interval == 0 and self.is_master:
+                with timer('eval'):
+                    self.evaluation()
+                self.step_metrics.update(eval=timer.times['eval'], valid_iter=self.valid_iter, valid_loss=self.valid_loss,
+                                         valid_ppl=self.valid_ppl)
+
+            # save the full training state
+            if config.checkpoint_dir is not None and self.iter_num % config.checkpoint_interval == 0 and self.is_master:
+                with timer('checkpoint'):
+                    self._save_periodic_checkpoint()
+                self.step_metrics['checkpoint'] = timer.times['checkpoint']
+
+            if sink is not None:
+                sink.write(self.step_metrics)
 
             # termination conditions
             if config.max_iters is not None and self.iter_num >= config.max_iters:
                 break
 
+        # wait for the last asynchronous evaluation
+        self._poll_evaluation(block=True)
+
         print(f"{'-'*10} Trainer Time Elapsed: {time.time() - start_time:.2f}s {'-'*10}")
@@ -28,6 +28,35 @@ def setup_logging(config):
     with open(os.path.join(work_dir, 'config.json'), 'w') as f:
         f.write(json.dumps(config.to_dict(), indent=4))
 
+def _read_proc_status_mb(field):
+    """ read a memory field (e.g. VmRSS, VmHWM) of this process from /proc, in MB; linux only """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024 # reported in kB
+    return 0.0
+
+def reset_peak_memory(device='cpu'):
+    """ start a new peak memory measurement window on the given device """
+    if str(device).startswith('cuda'):
+        torch.cuda.reset_peak_memory_stats(device)
+    elif os.path.exists('/proc/self/clear_refs'):
+        # writing 5 resets the peak resident set size (VmHWM) to the current one
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+
+def current_memory_mb(device='cpu'):
+    """ memory currently held by tensors (cuda) or by the whole process (cpu), in MB """
+    if str(device).startswith('cuda'):
+        return torch.cuda.memory_allocated(device) / 2**20
+    return _read_proc_status_mb('VmRSS') if os.path.exists('/proc/self/status') else 0.0
+
+def peak_memory_mb(device='cpu'):
+    """ peak memory since the last reset_peak_memory(device), in MB """
+    if str(device).startswith('cuda'):
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return _read_proc_status_mb('VmHWM') if os.path.exists('/proc/self/status') else 0.0
+
 class CfgNode:
     """ a lightweight configuration class inspired by yacs """
     def __init__(self, **kwargs):
@@ -1,4 +1,4 @@
-from data import load_data, create_datasets, create_dataloader, VOCAB_SIZE
+from data import load_data, create_datasets, create_packed_datasets, create_dataloader, VOCAB_SIZE
 import torch
 from gpt.model import GPT
 from gpt.trainer import Trainer
@@ -10,15 +10,18 @@ def batch_end_callback(trainer):
     trainer.all_iter_train_ppl.append(trainer.iter_train_ppl.item())
     if trainer.iter_num % 100 == 0:
         print(
-            f"iter_dt {trainer.iter_dt * 100:.2f}s; iter {trainer.iter_num}: "
-            f"train loss {trainer.iter_train_loss.item():.5f} train ppl {trainer.iter_train_ppl.item():.3f}")
+            f"iter_dt {trainer.iter_dt * 1000:.2f}ms (data wait {trainer.iter_data_wait_frac:.0%}); iter {trainer.iter_num}: "
+            f"train loss {trainer.iter_train_loss.item():.5f} train ppl {trainer.iter_train_ppl.item():.3f}; "
+            f"{trainer.step_metrics['tokens_per_sec']:.0f} tok/s; "
+            f"{trainer.config.precision} step memory +{trainer.iter_mem_delta:.1f}MB")
 
 
 def evaluation_callback(trainer):
-    print(f"iter {trainer.iter_num}: validation loss {trainer.valid_loss:.5f} validation ppl {trainer.valid_ppl:.3f}")
+    print(f"iter {trainer.valid_iter}: validation loss {trainer.valid_loss:.5f} validation ppl {trainer.valid_ppl:.3f}")
     if trainer.valid_ppl < trainer.best_valid_ppl:
         print(f"best model so far, saving...")
-        torch.save(trainer.model.state_dict(), 'model.pth')
+        # the weights the validation ran with, with async evaluation the model has moved on since
+        torch.save(trainer.valid_model_state, 'model.pth')
         trainer.best_valid_ppl = trainer.valid_ppl
 
 
@@ -33,10 +36,17 @@ def sample_from_trained_model(trained_model):
     generate(trained_model, prompt=' According to the latest research', num_samples=1, steps=30)
 
 
-def run(train_dataset, dev_dataset, max_iter=1, device='cpu', plot=True, sample=True):
-    # create dataloaders
-    train_dataloader = create_dataloader(train_dataset, batch_size=256, shuffle=True)
-    dev_dataloader = create_dataloader(dev_dataset, batch_size=256, shuffle=False)
+def run(train_dataset, dev_dataset, max_iter=1, device='cpu', plot=True, sample=True, micro_batch_size=None,
+        memory_budget_mb=None, checkpoint_dir=None, resume_from=None, distributed=False, num_workers=2,
+        metrics_path=None, eval_subset=None, eval_async=False, bucket=False, max_tokens=None, prefetch_batches=0):
+    # create dataloaders, collating in worker processes and pinning the batches for fast copies to the gpu.
+    # with bucket the training batches group sequences of similar length, so that they need less padding,
+    # and with max_tokens they hold about that many tokens each instead of 256 sequences
+    pin_memory = device != 'cpu'
+    train_dataloader = create_dataloader(train_dataset, batch_size=256, shuffle=True, num_workers=num_workers,
+                                         pin_memory=pin_memory, bucket=bucket, max_tokens=max_tokens)
+    dev_dataloader = create_dataloader(dev_dataset, batch_size=256, shuffle=False, num_workers=num_workers,
+                                       pin_memory=pin_memory)
 
     # create model
     model_config = GPT.get_default_config()
@@ -49,13 +59,29 @@ def run(train_dataset, dev_dataset, max_iter=1, device='cpu', plot=True, sample=
     train_config = Trainer.get_default_config()
     train_config.learning_rate = 5e-4  # the model we're using is so small that we can go a bit faster
     train_config.max_iters = max_iter
-    train_config.num_workers = 0
+    train_config.num_workers = num_workers
     train_config.device = device
+    # accumulate the 256 sequence batches over smaller micro-batches on memory constrained nodes
+    train_config.micro_batch_size = micro_batch_size
+    train_config.memory_budget_mb = memory_budget_mb
+    # periodic checkpoints of the full training state, and where to pick up from
+    train_config.checkpoint_dir = checkpoint_dir
+    train_config.resume_from = resume_from
+    train_config.distributed = distributed
+    # fetch and copy the next batches to the device on a background thread while the step runs
+    train_config.prefetch_batches = prefetch_batches
+    # per-step timings, throughput and memory as JSON lines, to compare runs across commits
+    train_config.metrics_path = metrics_path
+    # validate on a fixed random subset of the dev set, optionally in a separate process
+    train_config.eval_subset = eval_subset
+    train_config.eval_async = eval_async
     trainer = Trainer(train_config, model, train_dataloader, dev_dataloader)
     trainer.set_callback('on_batch_end', batch_end_callback)
     trainer.set_callback('on_validation_end', evaluation_callback)
 
     trainer.run()
+    if not trainer.is_master:
+        return
     if plot:
         trainer.plot()
     if sample:
@@ -67,15 +93,32 @@ def cpu_gpu_comparison(train_dataset, dev_dataset, max_iter=100):
 
 
 def gpu_full_run(train_dataset, dev_dataset, max_iter=20000):
-    run(train_dataset, dev_dataset, max_iter=max_iter, device='cuda', plot=True, sample=True)
+    # a killed run picks up from its newest checkpoint when started again
+    run(train_dataset, dev_dataset, max_iter=max_iter, device='cuda', plot=True, sample=True,
+        checkpoint_dir='checkpoints', resume_from='latest', metrics_path='metrics/gpu_full_run.jsonl')
+
+
+def ddp_cpu_run(train_dataset, dev_dataset, max_iter=20000):
+    # launch one process per worker with e.g. `torchrun --nproc_per_node=4 main.py`, the processes
+    # all-reduce their gradients over gloo, so this scales across the cores and cpu nodes we have
+    run(train_dataset, dev_dataset, max_iter=max_iter, device='cpu', plot=True, sample=False,
+        checkpoint_dir='checkpoints', resume_from='latest', distributed=True)
 
 
 if __name__ == '__main__':
-    # load raw data for lm
-    train_data, dev_data = load_data()
+    # True trains on wikitext that was tokenized once and memory-mapped from the disk cache (no padding)
+    use_memmap = False
 
-    # create datasets
-    train_d, dev_d = create_datasets(train_data, dev_data, block_size=32)
+    if use_memmap:
+        train_d, dev_d = create_packed_datasets(block_size=32)
+    else:
+        # load raw data for lm
+        train_data, dev_data = load_data()
+
+        # create datasets
+        train_d, dev_d = create_datasets(train_data, dev_data, block_size=32)
+        # alternatively, pack several lines into every row, which then attend and are scored per line (hardly any padding)
+        # train_d, dev_d = create_datasets(train_data, dev_data, block_size=32, segment_pack=True)
 
     # TODO: run cpu & gpu comparison
     # uncomment the following line to run
@@ -85,3 +128,7 @@ if __name__ == '__main__':
     # uncomment the following line to run
     gpu_full_run(train_d, dev_d, max_iter=20000)
 
+    # run the full training with distributed data parallel on cpus
+    # uncomment the following line and launch with torchrun to run
+    # ddp_cpu_run(train_d, dev_d, max_iter=20000)
+
@@ -0,0 +1,52 @@
+import os
+import random
+
+import pytest
+
+from gpt.bpe import Encoder, get_encoder, get_pairs
+
+
+def make_encoder(seed=0, num_merges=300, alphabet='abcd01 Ġ'):
+    """ an Encoder with random merges over a small alphabet, so that long chains of merges apply to random words """
+    rng = random.Random(seed)
+    symbols, merges = list(alphabet), []
+    while len(merges) < num_merges:
+        pair = (rng.choice(symbols), rng.choice(symbols))
+        if pair not in merges and len(''.join(pair)) <= 8:
+            merges.append(pair)
+            symbols.append(''.join(pair))
+    return Encoder({}, merges)
+
+
+def merge_both(encoder, word):
+    word = tuple(word)
+    return encoder._merge_classic(word, get_pairs(word)), encoder._merge_heap(word)
+
+
+@pytest.mark.parametrize('word', ['ab', 'aaaaaaa', 'abababab', '0000000000', 'ĠĠĠĠĠĠĠĠ', 'abcd01 Ġabcd01 Ġ', 'dcba10'])
+def test_merge_engines_agree_on_fixed_words(word):
+    classic, heap = merge_both(make_encoder(), word)
+    assert classic == heap
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_merge_engines_agree_on_random_words(seed):
+    rng = random.Random(seed)
+    encoder = make_encoder(seed)
+    for _ in range(500):
+        word = ''.join(rng.choice('abcd01 Ġ') for _ in range(rng.randint(2, 60)))
+        classic, heap = merge_both(encoder, word)
+        assert classic == heap, word
+
+
+@pytest.mark.skipif(not os.path.isfile(os.path.join(os.path.expanduser('~'), '.cache', 'gpt', 'vocab.bpe')),
+                    reason="the GPT-2 merges aren't downloaded")
+def test_merge_engines_agree_on_gpt2_merges():
+    # random texts mixing letters, digits, punctuation, whitespace runs and multi-byte characters
+    rng = random.Random(3407)
+    classic, heap = get_encoder(), get_encoder()
+    classic.merge_engine = 'classic'
+    alphabet = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 .,:;!?/-_=\'"\n\téüñ中文🤗'
+    for _ in range(2000):
+        text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 200)))
+        assert heap.encode(text) == classic.encode(text), text
@@ -0,0 +1,56 @@
+import copy
+import pickle
+
+import pytest
+import torch
+
+from gpt.model import GPT
+from gpt.quantize import quantize_weight_only
+
+
+def make_model():
+    torch.manual_seed(0)
+    config = GPT.get_default_config()
+    config.model_type = 'gpt-nano'
+    config.vocab_size = 100
+    config.block_size = 16
+    return GPT(config).eval()
+
+
+def test_compiled_decode_uses_the_weights_of_copies():
+    model = make_model().compile_decode(backend='eager')
+    idx = torch.randint(100, (2, 4), generator=torch.Generator().manual_seed(1))
+    model.generate(idx, 4)
+
+    copied = copy.deepcopy(model)
+    with torch.no_grad():
+        for p in copied.parameters():
+            p.add_(torch.randn_like(p))
+    eager = copy.deepcopy(copied)
+    eager._decode_backend = None
+    assert torch.equal(copied.generate(idx, 8), eager.generate(idx, 8))
+
+    quantized = quantize_weight_only(model)
+    eager = quantize_weight_only(model)
+    eager._decode_backend = None
+    assert torch.equal(quantized.generate(idx, 8), eager.generate(idx, 8))
+
+    pickle.loads(pickle.dumps(model)).generate(idx, 4)
+
+
+def test_speculative_decoding_takes_the_options_of_generate():
+    # greedy speculative decoding produces exactly the greedy tokens of the model, with every option
+    model, draft = make_model(), make_model()
+    with torch.no_grad():
+        for p in draft.parameters():
+            p.add_(0.1 * torch.randn_like(p))
+    idx = torch.randint(100, (1, 4), generator=torch.Generator().manual_seed(1))
+    options = dict(top_k=20, top_p=0.8, min_p=0.1, repetition_penalty=1.5, stop_token=int(model.generate(idx, 6)[0, -1]))
+    assert torch.equal(model.generate(idx, 10, draft_model=draft, speculative_k=3, **options),
+                       model.generate(idx, 10, **options))
+
+
+def test_beam_search_rejects_sampling():
+    idx = torch.zeros(1, 1, dtype=torch.long)
+    with pytest.raises(AssertionError):
+        make_model().generate(idx, 4, num_beams=2, do_sample=True, top_p=0.9)
@@ -0,0 +1,38 @@
+import math
+
+import pytest
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from gpt.model import GPT
+from gpt.quantize import quantize_dynamic, quantize_weight_only
+from gpt.trainer import evaluate_loader
+
+
+def perplexity(model, loader):
+    loss_sum, tokens = evaluate_loader(model, loader, 'cpu')
+    return math.exp(loss_sum / tokens)
+
+
+@pytest.mark.parametrize('quantize', [quantize_dynamic, quantize_weight_only])
+def test_quantized_perplexity_within_tolerance(quantize):
+    torch.manual_seed(0)
+    config = GPT.get_default_config()
+    config.model_type = 'gpt-nano'
+    config.vocab_size = 100
+    config.block_size = 32
+    model = GPT(config).eval()
+    # a model that has memorized part of its data, so that the quantization error shows in the perplexity
+    tokens = torch.randint(100, (64, 32), generator=torch.Generator().manual_seed(1))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+    model.train()
+    for _ in range(50):
+        _, loss = model(tokens[:, :-1], tokens[:, 1:])
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    loader = DataLoader(TensorDataset(tokens[:, :-1], tokens[:, 1:], torch.ones(64, 31)), batch_size=16)
+
+    ppl, quantized_ppl = perplexity(model, loader), perplexity(quantize(model), loader)
+    assert ppl < 10
+    assert quantized_ppl / ppl - 1 <= 0.02
@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+import torch
+
+from gpt.model import GPT
+from gpt.server import InferenceServer
+
+
+def make_server():
+    torch.manual_seed(0)
+    config = GPT.get_default_config()
+    config.model_type = 'gpt-nano'
+    config.vocab_size = 100
+    config.block_size = 64
+    return InferenceServer(GPT(config), max_batch_size=4)
+
+
+async def drain(req):
+    """ the tokens of req up to the end of its stream, and what ended it """
+    tokens = []
+    while isinstance(token := await req.tokens.get(), int):
+        tokens.append(token)
+    return tokens, token
+
+
+def test_failed_step_fails_its_requests():
+    async def serve():
+        server = make_server()
+        step = server._step
+
+        def failing_step(new):
+            if any(req.prompt_ids == [9] for req in new):
+                raise RuntimeError('step failed')
+            return step(new)
+
+        server._step = failing_step
+        async with server:
+            in_flight = await server.submit([1, 2, 3], max_new_tokens=50)
+            await in_flight.tokens.get()
+            poison = await server.submit([9], max_new_tokens=5)
+            results = [await drain(in_flight), await drain(poison)]
+            # the server goes on serving from an empty batch
+            results.append(await drain(await server.submit([7, 8], max_new_tokens=3)))
+        return results
+
+    (_, in_flight), (poison_tokens, poison), (after, end) = asyncio.run(serve())
+    assert isinstance(in_flight, RuntimeError) and isinstance(poison, RuntimeError)
+    assert poison_tokens == []
+    assert len(after) == 3 and end is None
+
+
+def test_stream_raises_the_error():
+    async def serve():
+        server = make_server()
+        server._step = lambda new: 1 / 0
+        async with server:
+            return [token async for token in server.stream([1, 2])]
+
+    with pytest.raises(ZeroDivisionError):
+        asyncio.run(serve())
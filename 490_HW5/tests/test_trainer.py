@@ -0,0 +1,64 @@
+import math
+import os
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from gpt.model import GPT
+from gpt.trainer import Trainer, evaluate_loader
+
+
+def make_trainer(checkpoint_dir, max_iters, resume_from=None, **overrides):
+    torch.manual_seed(0)
+    model_config = GPT.get_default_config()
+    model_config.model_type = 'gpt-nano'
+    model_config.vocab_size = 100
+    model_config.block_size = 16
+    model = GPT(model_config)
+    tokens = torch.randint(100, (64, 16), generator=torch.Generator().manual_seed(1))
+    dataset = TensorDataset(tokens, tokens, torch.ones(64, 16))
+    train_config = Trainer.get_default_config()
+    train_config.device = 'cpu'
+    train_config.num_workers = 0
+    train_config.max_iters = max_iters
+    train_config.eval_interval = 100
+    train_config.checkpoint_dir = checkpoint_dir
+    train_config.checkpoint_interval = 3
+    train_config.resume_from = resume_from
+    train_config.merge_from_dict(overrides)
+    return Trainer(train_config, model, DataLoader(dataset, batch_size=8, shuffle=True), DataLoader(dataset, batch_size=8))
+
+
+def test_resume_is_bit_exact(tmp_path):
+    # dropout draws from the rng, so the resumed steps only match if every rng state came back too
+    trainer = make_trainer(str(tmp_path), max_iters=6)
+    trainer.run()
+    resumed = make_trainer(str(tmp_path), max_iters=6, resume_from=os.path.join(tmp_path, 'ckpt_00000003.pt'))
+    resumed.run()
+
+    assert resumed.iter_num == trainer.iter_num
+    assert resumed.all_iter_train_loss == trainer.all_iter_train_loss
+    for name, tensor in trainer.model.state_dict().items():
+        assert torch.equal(tensor, resumed.model.state_dict()[name]), name
+
+
+def test_checkpoint_loads_weights_only(tmp_path):
+    trainer = make_trainer(str(tmp_path), max_iters=3)
+    trainer.run()
+    checkpoint = torch.load(os.path.join(tmp_path, 'ckpt_00000003.pt'), weights_only=True)
+    assert checkpoint['iter_num'] == 3
+
+
+def test_async_evaluation(tmp_path):
+    # the snapshot is validated in a spawned process, its results must be those of the state that becomes best.pt
+    trainer = make_trainer(str(tmp_path), max_iters=4, eval_interval=2, eval_async=True)
+    trainer.run()
+
+    assert trainer.valid_iter == 4
+    assert len(trainer.all_iter_valid_ppl) == 3
+    assert not list(tmp_path.glob('eval_*.pt'))
+    best = torch.load(os.path.join(tmp_path, 'best.pt'), weights_only=True)
+    assert best['iter_num'] == trainer.valid_iter
+    trainer.model.load_state_dict(best['model'])
+    loss_sum, tokens = evaluate_loader(trainer.model, trainer.eval_dataloader, 'cpu')
+    assert math.isclose(math.exp(loss_sum / tokens), trainer.valid_ppl, rel_tol=1e-6)